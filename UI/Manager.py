@@ -6,7 +6,10 @@ Manager
 """
 
 import os
+import re
 import tornado.web
+import tornado.ioloop
+import tornado.template
 import tornado.websocket
 
 from core.configs import Configs
@@ -38,12 +41,81 @@ def mapping(mapping_path):
     return wrapper
 
 
+def load_templates(template_path):
+    """
+    compile every template under template_path now instead of on first render
+    templates that fail to compile or use unknown modules fail the startup
+    :param template_path: path
+    :return: tornado.template.Loader holding the compiled templates
+    """
+    loader = tornado.template.Loader(template_path)
+    errors = []
+    for directory, _, file_names in os.walk(template_path):
+        for file_name in sorted(file_names):
+            if not file_name.endswith('.html'):
+                continue
+            path = os.path.join(directory, file_name)
+            name = os.path.relpath(path, template_path).replace(os.sep, '/')
+            try:
+                loader.load(name)
+            except Exception as error:
+                errors.append("%s: %s" % (name, error))
+                continue
+            with open(path, 'rb') as template_file:
+                source = template_file.read()
+            for module_name in re.findall(r'{%\s*module\s+(\w+)', source):
+                if module_name not in module_dict:
+                    errors.append("%s: unknown module '%s'" % (name, module_name))
+    if errors:
+        raise ValueError("ValueError: templates failed to load:\n  %s" % '\n  '.join(errors))
+    return loader
+
+
 def create_app():
     __import__('UI.Page')
     __import__('UI.Module')
+    __import__('UI.SocketPage')
     from core.models_init import init
     init()
+    import core.models
+    from core.password import check_column
+    check_column(core.models.User.__table__.c.user_pass)
+    from core.username_index import UsernameIndex
+    core.models.run_in_session(UsernameIndex.instance().warm)
+    from core.verification import Verification
+    Verification.instance().start_sweeper(configs.verification_sweep_interval)
+    from core.catalog import Catalog
+    core.models.run_in_session(Catalog.instance().load)
+    from core.elements import ElementMatrix
+    core.models.run_in_session(ElementMatrix.instance().load)
+    if configs.element_matrix_refresh_interval:
+        ElementMatrix.instance().start_refresher(configs.element_matrix_refresh_interval)
+    from core.assets import Assets, StaticAssetHandler
+    Assets.instance().build()
+    if configs.metrics_enabled:
+        from core.metrics import Metrics
+        metrics = Metrics.instance()
+        metrics.register_stats('db_pool', core.models.get_pool_stats,
+                               counters=('connect', 'checkout', 'checkin', 'wait_count', 'wait_time'))
+        metrics.register_stats('user_cache', core.models.user_cache.stats,
+                               counters=('hits', 'misses', 'evictions'))
+        metrics.register_stats('username_index', UsernameIndex.instance().stats, counters=('hits', 'misses'))
+        metrics.register_stats('verification_pool', Verification.instance().pool_stats, counters=('hit', 'miss'))
+        # a count query for the sqlite store, wal readers never wait for writers
+        metrics.register_stats('verification_store', Verification.instance().store.stats,
+                               counters=('expired', 'evicted'))
+        metrics.register_stats('element_matrix', ElementMatrix.instance().stats, counters=('loads', ))
+        from UI.SocketPage import TopicRegistry
+        metrics.register_stats('websocket', TopicRegistry.instance().stats,
+                               counters=('published', 'delivered', 'dropped'))
+    if configs.metrics_enabled and configs.slow_callback_threshold_ms:
+        from core.metrics import SlowCallbackDetector
+        SlowCallbackDetector(configs.slow_callback_threshold_ms / 1000.0).install(tornado.ioloop.IOLoop.current())
     from core.configs import ROOT_PATH
+    template_path = os.path.join(ROOT_PATH, "template")
+    settings = dict()
+    if configs.template_precompile:
+        settings['template_loader'] = load_templates(template_path)
     return tornado.web.Application(
         handlers=[
             (path, page)
@@ -51,7 +123,10 @@ def create_app():
         ],
         ui_modules=module_dict,
         gzip=configs.gzip,
-        template_path=os.path.join(ROOT_PATH, "template"),
+        template_path=template_path,
         static_path=os.path.join(ROOT_PATH, "static"),
-        cookie_secret=configs.cookie_secret
+        static_handler_class=StaticAssetHandler,
+        cookie_secret=configs.cookie_secret,
+        websocket_ping_interval=configs.websocket_ping_interval,
+        **settings
     )
\ No newline at end of file
@@ -10,23 +10,56 @@ __author__ = 'Rnd495'
 import tornado.web
 
 import core.verification
+from core.cache import LRUCache
+from core.configs import Configs
 from Manager import mapping
 
+configs = Configs.instance()
+
+
+class CachedUIModule(tornado.web.UIModule):
+    """
+    CachedUIModule
+    UIModule whose html depends only on its arguments
+    subclasses implement render_fragment, its output is kept in fragment_cache
+    """
+    fragment_cache = LRUCache(configs.ui_fragment_cache_size)
+
+    def render(self, *args, **kwargs):
+        key = (type(self).__name__, args, tuple(sorted(kwargs.iteritems())))
+        try:
+            html = self.fragment_cache.get(key, None)
+        except TypeError:
+            # unhashable arguments are rendered every time
+            return self.render_fragment(*args, **kwargs)
+        if html is None:
+            html = self.render_fragment(*args, **kwargs)
+            self.fragment_cache.set(key, html)
+        return html
+
+    def render_fragment(self, *args, **kwargs):
+        raise NotImplementedError()
+
 
 @mapping(r'verification')
 class UIVerification(tornado.web.UIModule):
 
     def render(self):
-        code = core.verification.Verification.instance().new()
+        # use the code prepared by PageBase.prepare_verification_code if any
+        code = getattr(self.handler, 'verification_code', None)
+        if code is None:
+            with self.handler.timing.measure('captcha'):
+                code = core.verification.Verification.instance().new()
+        else:
+            self.handler.verification_code = None
         return self.render_string('ui/verification.html', code=code)
 
-    def javascript_files(self):
-        return "/static/js/verification-img-modal-popup.js"
+    # its script js/verification-img-modal-popup.js is part of the page bundles, see core.assets.BUNDLES
 
 
 @mapping(r'title')
-class UITitle(tornado.web.UIModule):
-    def render(self, title, subtitle=''):
+class UITitle(CachedUIModule):
+    def render_fragment(self, title, subtitle=''):
         return self.render_string('ui/title.html', title=title, subtitle=subtitle)
 
 
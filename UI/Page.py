@@ -7,16 +7,28 @@ Page
 
 __author__ = 'Rnd495'
 
+import time
+import json
+import hashlib
 import traceback
 
 import tornado.web
 import tornado.gen
+import tornado.escape
+from sqlalchemy.orm import joinedload, load_only
 
 import core.models
+from core import executors
+from core import metrics
 from core import verification
-from core.models import User, Monster
+from core.cache import RateLimiter
+from core.catalog import Catalog
+from core.password import hash_password, verify_password
+from core.profiler import Profiler
+from core.username_index import UsernameIndex
+from core.models import User, Monster, MonsterType, Element, Skill
 from core.configs import Configs
-from UI.Manager import mapping
+from UI.Manager import mapping, page_dict
 
 configs = Configs.instance()
 
@@ -54,30 +66,189 @@ class NoticeAndRedirectInterruption(Interruption):
                     style=self.style)
 
 
-class PageBase(tornado.web.RequestHandler):
+class UserCookieMixin(object):
+    """
+    UserCookieMixin
+    current user of a handler from the "user_id" and "user_identity" cookies,
+    shared by PageBase and the websocket handlers
+    """
+    @tornado.gen.coroutine
+    def run_query(self, function, *args, **kwargs):
+        """
+        run function(session, *args, **kwargs) in the database thread pool
+        with a session of its own, see core.models.run_in_session
+        :return: result of function, orm objects are detached
+        """
+        result = yield executors.get_database_pool().submit(core.models.run_in_session, function, *args, **kwargs)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def query_user(self, user_id):
+        """
+        User by user_id, served from core.models.user_cache when possible
+        """
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            raise tornado.gen.Return(None)
+        user = core.models.user_cache.get(user_id)
+        if user is None:
+            user = yield self.run_query(lambda db: db.query(User).filter(User.user_id == user_id).first())
+            if user is not None:
+                core.models.user_cache.set(user_id, user)
+        raise tornado.gen.Return(user)
+
+    def get_user_identity(self, user_id):
+        """
+        UserIdentity from the "user_identity" cookie if it belongs to user_id
+        """
+        if not configs.user_identity_cookie:
+            return None
+        value = self.get_secure_cookie("user_identity", None)
+        if not value:
+            return None
+        try:
+            identity = core.models.UserIdentity(**json.loads(value))
+        except (ValueError, TypeError):
+            return None
+        return identity if str(identity.user_id) == user_id else None
+
+    @tornado.gen.coroutine
+    def load_current_user(self):
+        """
+        identity from the cookie, else the User of the "user_id" cookie
+        :return: None when not logged in
+        """
+        user_id = self.get_secure_cookie("user_id", None)
+        current_user = self.get_user_identity(user_id) if user_id else None
+        if user_id and current_user is None:
+            current_user = yield self.query_user(user_id)
+        raise tornado.gen.Return(current_user)
+
+
+class PageBase(UserCookieMixin, tornado.web.RequestHandler):
     """
     PageBase
     """
+    # load current_user in prepare() off the IOLoop
+    # handlers that never use current_user turn it off
+    preload_current_user = True
+
     def __init__(self, application, request, **kwargs):
         tornado.web.RequestHandler.__init__(self, application, request, **kwargs)
         self._db = None
+        self.verification_code = None
+        self.timing = metrics.RequestTiming()
+        self._render_depth = 0
 
     @property
     def db(self):
+        """
+        session of this request, closed in on_finish
+        """
         if self._db is None:
-            self._db = core.models.get_new_session()
+            self._db = core.models.get_new_session(info=dict(timing=self.timing))
         return self._db
 
+    def on_finish(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        if configs.metrics_enabled:
+            self.timing.close_segment()
+            metrics.Metrics.instance().observe_request(
+                type(self).__name__, self.get_status(), self.request.request_time(), self.timing)
+
+    def _execute(self, transforms, *args, **kwargs):
+        if not configs.metrics_enabled:
+            return tornado.web.RequestHandler._execute(self, transforms, *args, **kwargs)
+        # every callback of this request runs in a HandlerContext
+        name = type(self).__name__
+        with metrics.handler_context(name, self.timing):
+            return tornado.web.RequestHandler._execute(self, transforms, *args, **kwargs)
+
+    def render_string(self, template_name, **kwargs):
+        # UIModules render inside the page, only the outermost template is timed
+        self._render_depth += 1
+        begin = time.time()
+        try:
+            return tornado.web.RequestHandler.render_string(self, template_name, **kwargs)
+        finally:
+            self._render_depth -= 1
+            if not self._render_depth:
+                self.timing.render += time.time() - begin
+
+    def write(self, chunk):
+        if isinstance(chunk, dict):
+            with self.timing.measure('serialize'):
+                chunk = tornado.escape.json_encode(chunk)
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+        tornado.web.RequestHandler.write(self, chunk)
+
+    @tornado.gen.coroutine
+    def run_query(self, function, *args, **kwargs):
+        """
+        UserCookieMixin.run_query, the queries are timed in this request
+        """
+        result = yield executors.get_database_pool().submit(
+            metrics.bind(self.timing, core.models.run_in_session, type(self).__name__), function, *args, **kwargs)
+        raise tornado.gen.Return(result)
+
+    def set_current_user_cookies(self, user, expires_days):
+        self.set_secure_cookie("user_id", str(user.user_id), expires_days)
+        if configs.user_identity_cookie:
+            self.set_secure_cookie(
+                "user_identity", json.dumps(core.models.UserIdentity.from_user(user).to_dict()), expires_days)
+
+    def clear_current_user_cookies(self):
+        core.models.invalidate_user(self.get_secure_cookie("user_id", None))
+        self.clear_cookie("user_id")
+        self.clear_cookie("user_identity")
+
+    @tornado.gen.coroutine
+    def prepare(self):
+        if self.preload_current_user:
+            self.current_user = yield self.load_current_user()
+
     def get_current_user(self):
         user_id = self.get_secure_cookie("user_id", None)
-        if user_id:
-            db = core.models.get_new_session()
-            current_user = db.query(User).filter(User.user_id == user_id).first()
-            db.close()
-        else:
-            current_user = None
+        if not user_id:
+            return None
+        current_user = self.get_user_identity(user_id)
+        if current_user is None:
+            current_user = self.db.query(User).filter(User.user_id == user_id).first()
         return current_user
 
+    def check_version_etag(self, *versions):
+        """
+        set an ETag made of versions, e.g. from core.models.get_version,
+        and of the query arguments, so every page and projection has its own,
+        instead of letting finish() hash the whole body
+        the response is private to the user and revalidated on every use
+        :return: True when the client copy is current, the status is set to 304
+                 and nothing should be written
+        """
+        key = repr((versions, sorted(self.request.query_arguments.iteritems())))
+        self.set_header('Etag', '"%s"' % hashlib.sha1(key).hexdigest()[:20])
+        self.set_header('Cache-Control', 'private, no-cache')
+        self.add_header('Vary', 'Cookie')
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+        return False
+
+    def get_target_user_id(self):
+        """
+        int param user_id, else id of the current user, None if neither is usable
+        """
+        user_id = self.get_argument('user_id', None)
+        if user_id is None:
+            return self.current_user.user_id if self.current_user else None
+        try:
+            return int(user_id)
+        except ValueError:
+            return None
+
     def get_login_url(self):
         return '/login'
 
@@ -122,6 +293,15 @@ class PageBase(tornado.web.RequestHandler):
         else:
             self.send_error(500, exc_info=sys.exc_info())
 
+    @tornado.gen.coroutine
+    def prepare_verification_code(self):
+        """
+        render the verification code of this page off the IOLoop
+        picked up by the 'verification' UIModule
+        """
+        with self.timing.measure('captcha'):
+            self.verification_code = yield verification.Verification.instance().new_async()
+
     def get_referer(self):
         return self.request.headers.get('referer', None)
 
@@ -147,28 +327,31 @@ class PageBase(tornado.web.RequestHandler):
             error_msg='',
             data=data)
 
+    @tornado.gen.coroutine
     def get_user(self):
         if not self.current_user:
-            return dict(
+            raise tornado.gen.Return(dict(
                 success=False,
                 reason='need login first'
-            )
+            ))
         user_id = self.get_argument('user_id', None)
         if user_id is None:
+            user_id = self.current_user.user_id
+        if isinstance(self.current_user, User) and str(self.current_user.user_id) == str(user_id):
             user = self.current_user
         else:
-            user = self.db.query(User).filter(User.user_id == user_id).first()
-            self.db.close()
-            if not user:
-                return dict(
-                    success=False,
-                    reason='user is not found by user_id = "%s"' % user_id
-                )
-        return dict(
+            # current_user may be a UserIdentity only
+            user = yield self.query_user(user_id)
+        if not user:
+            raise tornado.gen.Return(dict(
+                success=False,
+                reason='user is not found by user_id = "%s"' % user_id
+            ))
+        raise tornado.gen.Return(dict(
             success=True,
             reason='ok',
             user=user
-        )
+        ))
 
 
 @mapping('/login')
@@ -179,18 +362,22 @@ class PageLogin(PageBase):
     def __init__(self, application, request, **kwargs):
         PageBase.__init__(self, application, request, **kwargs)
 
+    @tornado.gen.coroutine
     def get(self):
         next_page = self.get_argument('next', '/')
         if self.current_user:
             self.redirect(next_page)
-        return self.render('login.html', next=next_page)
+            return
+        yield self.prepare_verification_code()
+        self.render('login.html', next=next_page)
 
     @verification.check
+    @tornado.gen.coroutine
     def post(self):
         username = self.get_body_argument('username')
         password = self.get_body_argument('password')
         remember = self.get_body_argument('remember-me', True)
-        self.login(self, username, password, remember)
+        yield self.login(self, username, password, remember)
         if self.current_user:
             redirect = self.get_argument('next', '/')
             self.redirect(redirect)
@@ -202,18 +389,31 @@ class PageLogin(PageBase):
                 countdown=10, style='warning')
 
     @staticmethod
+    @tornado.gen.coroutine
     def login(page, username, password, remember=True):
-        password = User.password_hash(password)
         expire = 30 if remember else 1
-        user = page.db.query(User).filter(User.user_name == username, User.user_pass == password).first()
-        page.db.close()
+        user = yield page.run_query(
+            lambda db: db.query(User).filter(User.user_name == username).first())
+        if user:
+            # the kdf runs in the password pool, the IOLoop keeps serving
+            success, upgraded = yield executors.get_password_pool().submit(
+                verify_password, password, user.user_pass)
+            if not success:
+                user = None
+            elif upgraded is not None:
+                # legacy or outdated hash, store it with the current algorithm and cost
+                yield page.run_query(
+                    lambda db: db.query(User).filter(User.user_id == user.user_id).update(
+                        {User.user_pass: upgraded}, synchronize_session=False))
+                user.user_pass = upgraded
         if user:
-            page.set_secure_cookie("user_id", str(user.user_id), expire)
+            page.set_current_user_cookies(user, expire)
+            core.models.user_cache.set(user.user_id, user)
             page.current_user = user
-            return user
+            raise tornado.gen.Return(user)
         else:
-            page.clear_cookie("user_id")
-            return None
+            page.clear_current_user_cookies()
+            raise tornado.gen.Return(None)
 
 
 @mapping('/logout')
@@ -221,6 +421,8 @@ class PageLogout(PageBase):
     """
     PageLogout
     """
+    preload_current_user = False
+
     def __init__(self, application, request, **kwargs):
         PageBase.__init__(self, application, request, **kwargs)
 
@@ -231,7 +433,7 @@ class PageLogout(PageBase):
 
     @staticmethod
     def logout(page):
-        page.clear_cookie('user_id')
+        page.clear_current_user_cookies()
         page.current_user = None
 
 
@@ -243,10 +445,13 @@ class PageRegister(PageBase):
     def __init__(self, application, request, **kwargs):
         PageBase.__init__(self, application, request, **kwargs)
 
+    @tornado.gen.coroutine
     def get(self):
+        yield self.prepare_verification_code()
         self.render('register.html')
 
     @verification.check
+    @tornado.gen.coroutine
     def post(self):
         username = self.get_body_argument('username')
         password = self.get_body_argument('password')
@@ -260,7 +465,7 @@ class PageRegister(PageBase):
                 title='register error', redirect_to='/register',
                 countdown=10)
         # username availability check
-        result = APIGetUsernameAvailability.check(username=username, check_exists=True)
+        result = yield APIGetUsernameAvailability.check(self, username=username, check_exists=True, authoritative=True)
         if not result['availability']:
             raise NoticeAndRedirectInterruption(
                 message=result['reason'],
@@ -274,15 +479,16 @@ class PageRegister(PageBase):
                 countdown=10)
 
         # register new user
-        user = core.models.User(name=username, pwd=password, role_id=3)
-        try:
-            self.db.add(user)
-            self.db.commit()
-        except:
-            self.db.rollback()
-            raise
-        finally:
-            self.db.close()
+        pwd_hash = yield executors.get_password_pool().submit(hash_password, password)
+
+        def add_user(db):
+            user = core.models.User(name=username, pwd_hash=pwd_hash, role_id=3)
+            db.add(user)
+            db.flush()
+            return user.user_id
+        user_id = yield self.run_query(add_user)
+        core.models.invalidate_user(user_id)
+        UsernameIndex.instance().add(username)
 
         # redirect to login page
         self.redirect('/login')
@@ -308,6 +514,9 @@ class APIGetUsernameAvailability(PageBase):
     api for register page
     check the availability of the username
 
+    answered from UsernameIndex when the name is certainly free
+    rate limited per client, HTTP 429 when exceeded
+
     method: get
     param username: str
     result:
@@ -316,27 +525,43 @@ class APIGetUsernameAvailability(PageBase):
       reason: str
     }
     """
+    preload_current_user = False
+    rate_limiter = RateLimiter(configs.username_availability_rate, configs.username_availability_burst)
+
     def __init__(self, application, request, **kwargs):
         PageBase.__init__(self, application, request, **kwargs)
 
+    @tornado.gen.coroutine
     def get(self):
+        if not self.rate_limiter.allow(self.request.remote_ip):
+            self.set_status(429, 'Too Many Requests')
+            self.write(dict(availability=False, reason='too many requests, try again later.'))
+            return
         username = self.get_query_argument('username')
-        self.write(APIGetUsernameAvailability.check(username=username, check_exists=True))
+        result = yield APIGetUsernameAvailability.check(self, username=username, check_exists=True)
+        self.write(result)
 
     @classmethod
-    def check(cls, username, check_exists=True):
+    @tornado.gen.coroutine
+    def check(cls, page, username, check_exists=True, authoritative=False):
+        """
+        :param authoritative: always ask the database, UsernameIndex may miss names
+                              registered by other processes
+        """
         result = dict(availability=True, reason='ok')
         if not username:
             result = dict(availability=False, reason='username can not be empty.')
         elif len(username) > 16:
             result = dict(availability=False, reason='username "%s" is too long.' % username)
         elif check_exists:
-            db = core.models.get_new_session()
-            count = db.query(User).filter(User.user_name == username).count()
-            db.close()
-            if count > 0:
+            if authoritative or UsernameIndex.instance().might_exist(username):
+                exists = yield page.run_query(
+                    lambda db: db.query(User.user_id).filter(User.user_name == username).limit(1).first() is not None)
+            else:
+                exists = False
+            if exists:
                 result = dict(availability=False, reason='username "%s" is already exists.' % username)
-        return result
+        raise tornado.gen.Return(result)
 
 
 @mapping('/api/create_verification_code')
@@ -352,17 +577,85 @@ class APICreateVerificationCode(PageBase):
     result:
     {
       uuid: str,
-      image: str
+      image: str     (url of the image)
     }
     """
+    preload_current_user = False
+
     def __init__(self, application, request, **kwargs):
         PageBase.__init__(self, application, request, **kwargs)
 
+    @tornado.gen.coroutine
     def get(self):
-        code = verification.Verification.instance().new()
+        with self.timing.measure('captcha'):
+            code = yield verification.Verification.instance().new_async()
         self.write({'uuid': code.uuid, 'image': code.image})
 
 
+@mapping(r'/verification/(\w+)\.(png|gif)')
+class PageVerificationImage(PageBase):
+    """
+    PageVerificationImage
+
+    raw image of a verification code
+    the image never changes for a uuid, so it is cacheable by the client
+    until the code expires
+    """
+    preload_current_user = False
+
+    def __init__(self, application, request, **kwargs):
+        PageBase.__init__(self, application, request, **kwargs)
+
+    @tornado.gen.coroutine
+    def get(self, uuid, image_format):
+        code = yield verification.Verification.instance().get_async(uuid)
+        if code is None or code.image_format != image_format:
+            raise tornado.web.HTTPError(404)
+        max_age = max(int(code.begin_timestamp + code.available_time - time.time()), 0)
+        self.set_header('Content-Type', verification.Verification.IMAGE_MIME_TYPES[image_format])
+        self.set_header('Cache-Control', 'private, max-age=%d' % max_age)
+        self.write(code.image_data)
+
+
+@mapping('/api/catalog')
+class APICatalog(PageBase):
+    """
+    APICatalog
+
+    api to get the static game reference data
+    the response carries an ETag of the catalog version,
+    send it back in If-None-Match to get a 304 while it is unchanged
+
+    method: get
+    no param
+    result:
+    {
+      roles: [{role_id: int, role_name: str}, ...],
+      elements: [{element_id: int, element_name: str}, ...],
+      element_effects: [{atk_element_id: int, def_element_id: int, effect: float}, ...],
+      monster_types: [...],
+      skills: [...],
+      skill_types: [...],
+      skill_target_types: [...],
+      sp_skills: [...]
+    }
+    """
+    preload_current_user = False
+
+    def __init__(self, application, request, **kwargs):
+        PageBase.__init__(self, application, request, **kwargs)
+
+    def get(self):
+        catalog = Catalog.instance()
+        self.set_header('Etag', '"%s"' % catalog.version)
+        self.set_header('Cache-Control', 'public, max-age=%d' % configs.catalog_max_age)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(catalog.body)
+
+
 @mapping('/api/check_verification_code')
 class APICheckVerificationCode(PageBase):
     """
@@ -380,9 +673,12 @@ class APICheckVerificationCode(PageBase):
       ok: bool
     }
     """
+    preload_current_user = False
+
     def __init__(self, application, request, **kwargs):
         PageBase.__init__(self, application, request, **kwargs)
 
+    @tornado.gen.coroutine
     def get(self):
         try:
             code = self.get_argument("ver_code")
@@ -390,7 +686,7 @@ class APICheckVerificationCode(PageBase):
         except tornado.web.HTTPError:
             self.write({'success': False, 'ok': False})
             return
-        ok = verification.Verification.instance().check(uuid, code)
+        ok = yield verification.Verification.instance().check_async(uuid, code)
         self.write({'success': True, 'ok': ok})
 
 
@@ -415,12 +711,17 @@ class APIUserLogin(PageBase):
       reason: str
     }
     """
+    preload_current_user = False
+
     def __init__(self, application, request, **kwargs):
         PageBase.__init__(self, application, request, **kwargs)
 
+    @tornado.gen.coroutine
     def get(self):
-        self.write(self.login())
+        result = yield self.login()
+        self.write(result)
 
+    @tornado.gen.coroutine
     def login(self):
         username = self.get_argument('username')
         password = self.get_argument('password')
@@ -432,15 +733,15 @@ class APIUserLogin(PageBase):
             try:
                 password = password.decode('base64')
             except:
-                return dict(
+                raise tornado.gen.Return(dict(
                     success=False,
                     reason='"%s" is not base64 encoded.' % password
-                )
-        success = PageLogin.login(self, username, password, remember)
-        return dict(
+                ))
+        success = yield PageLogin.login(self, username, password, remember)
+        raise tornado.gen.Return(dict(
             success=bool(success),
             reason='ok'
-        )
+        ))
 
 
 @mapping('/api/user/logout')
@@ -459,6 +760,8 @@ class APIUserLogout(PageBase):
       reason: str
     }
     """
+    preload_current_user = False
+
     def __init__(self, application, request, **kwargs):
         PageBase.__init__(self, application, request, **kwargs)
 
@@ -482,6 +785,7 @@ class APIUserBasicInfo(PageBase):
     this api needs login first
     when param user_id leaves blank
     this api returns basic info of current user
+    answers 304 to If-None-Match with an unchanged ETag
 
     method: get
     param user_id: int | null
@@ -500,27 +804,31 @@ class APIUserBasicInfo(PageBase):
     def __init__(self, application, request, **kwargs):
         PageBase.__init__(self, application, request, **kwargs)
 
+    @tornado.gen.coroutine
     def get(self):
-        self.write(self.get_basic_info())
+        user_id = self.get_target_user_id()
+        if self.current_user and user_id is not None and self.check_version_etag(
+                self.current_user.user_id, user_id, core.models.get_version('user', user_id)):
+            return
+        result = yield self.get_basic_info()
+        self.write(result)
 
+    @tornado.gen.coroutine
     def get_basic_info(self):
-        user_result = self.get_user()
+        user_result = yield self.get_user()
         if not user_result['success']:
-            return user_result
+            raise tornado.gen.Return(user_result)
         else:
             user = user_result['user']
 
-        # get user model dict
-        data = user.to_dict()
-
-        # drop secret field
-        data.pop('user_pass')
+        # get user model dict without secret field
+        data = user.to_dict(exclude=('user_pass',))
 
-        return dict(
+        raise tornado.gen.Return(dict(
             success=True,
             reason='ok',
             data=data
-        )
+        ))
 
 
 @mapping('/api/user/has_monster/basic_info/list')
@@ -532,13 +840,25 @@ class APIUserHasMonsterBasicInfoList(PageBase):
     this api needs login first
     when param user_id leaves blank
     this api returns basic info of current user
+    monsters are ordered by monster_id and paged,
+    pass next_after as param after to get the next page
+    when param stream is true, every monster after param after is
+    sent in chunks of monster_list_stream_chunk_size, next_after is left out
+    answers 304 to If-None-Match with an unchanged ETag
 
     method: get
     param user_id: int | null
+    param limit: int | null     (monster_list_page_size, at most monster_list_max_page_size)
+    param offset: int | null    (ignored with after)
+    param after: int | null     (monster_id of the last monster of the previous page)
+    param fields: str | null    (comma separated monster fields, monster_id is always included)
+    param include: str | null   (comma separated from monster_type, element, skills)
+    param stream: bool | null
     result:
     {
       success: bool,
       reason: str,
+      next_after: int | null,
       data: [
       {
         monster_id: int,
@@ -557,30 +877,243 @@ class APIUserHasMonsterBasicInfoList(PageBase):
         monster_hunger: int,
         monster_energy: int,
         monster_type_id: int,
-        monster_owner_id: int
+        monster_owner_id: int,
+        monster_type: {monster_type_id: int, ...} | null    (include monster_type only)
+        element: {element_id: int, element_name: str} | null     (include element only)
+        skills: [{skill_id: int, ...}, ...]     (include skills only)
       },
       ...
       ]
     }
     """
+    FIELDS = frozenset(column.key for column in Monster.__table__.columns)
+    # relation name to model of the related rows
+    RELATIONS = dict(monster_type=MonsterType, element=Element, skills=Skill)
+
     def __init__(self, application, request, **kwargs):
         PageBase.__init__(self, application, request, **kwargs)
 
+    @tornado.gen.coroutine
     def get(self):
-        self.write(self.get_monster_basic_info_list())
+        params = self.get_list_params()
+        if not params['success']:
+            self.write(params)
+            return
+        user_id = self.get_target_user_id()
+        if self.current_user and user_id is not None and self.check_version_etag(
+                self.current_user.user_id, user_id, core.models.get_version('monsters', user_id),
+                Catalog.instance().version if params['include'] else None):
+            return
+        if params['stream']:
+            yield self.stream_monster_basic_info_list(params)
+            return
+        result = yield self.get_monster_basic_info_list(params)
+        self.write(result)
+
+    def get_list_params(self):
+        params = dict(success=True, reason='ok')
+        for name, convert, default in (('limit', int, configs.monster_list_page_size),
+                                       ('offset', int, 0),
+                                       ('after', int, None),
+                                       ('stream', lambda s: s.lower() == 'true', False)):
+            result = self.get_converted_param(name, convert)
+            if result['success']:
+                params[name] = result['data']
+            elif self.get_argument(name, None) is None:
+                params[name] = default
+            else:
+                return result
+        if not 0 < params['limit'] <= configs.monster_list_max_page_size:
+            return dict(success=False, reason='param "limit" should be in 1 ~ %d.' % configs.monster_list_max_page_size)
+        # a negative OFFSET is an SQL error on most databases
+        if params['offset'] < 0:
+            return dict(success=False, reason='illegal param "offset" = "%d".' % params['offset'])
+        fields = self.get_argument('fields', None)
+        if fields:
+            fields = set(field.strip() for field in fields.split(',') if field.strip())
+            unknown = fields - self.FIELDS
+            if unknown:
+                return dict(success=False, reason='unknown fields "%s".' % ','.join(sorted(unknown)))
+            fields.add('monster_id')
+        params['fields'] = fields or None
+        include = self.get_argument('include', None)
+        include = set(name.strip() for name in include.split(',') if name.strip()) if include else set()
+        unknown = include - set(self.RELATIONS)
+        if unknown:
+            return dict(success=False, reason='unknown include "%s".' % ','.join(sorted(unknown)))
+        params['include'] = include
+        return params
 
-    def get_monster_basic_info_list(self):
-        user_result = self.get_user()
+    @classmethod
+    def query_page(cls, db, user_id, limit, offset=0, after=None, fields=None, include=()):
+        """
+        one page of monsters as dicts, relations are eager loaded in the same query
+        meant to be run by PageBase.run_query
+        """
+        query = db.query(Monster).filter(Monster.monster_owner_id == user_id).order_by(Monster.monster_id)
+        if fields is not None:
+            query = query.options(load_only(*fields))
+        for name in include:
+            query = query.options(joinedload(name))
+        if after is not None:
+            query = query.filter(Monster.monster_id > after)
+        elif offset:
+            query = query.offset(offset)
+        monsters = query.limit(limit).all()
+        with metrics.current_timing().measure('serialize'):
+            data = Monster.to_dicts(monsters, include=fields)
+            for name in include:
+                model = cls.RELATIONS[name]
+                for fields_dict, monster in zip(data, monsters):
+                    related = getattr(monster, name)
+                    if isinstance(related, list):
+                        fields_dict[name] = model.to_dicts(related)
+                    else:
+                        fields_dict[name] = related.to_dict() if related is not None else None
+        return data
+
+    @tornado.gen.coroutine
+    def get_monster_basic_info_list(self, params):
+        user_result = yield self.get_user()
         if not user_result['success']:
-            return user_result
+            raise tornado.gen.Return(user_result)
         else:
             user = user_result['user']
 
-        session = core.models.get_new_session()
-        monster_list = session.query(Monster).filter(Monster.monster_owner_id == user.user_id).all()
-        monster_basic_info_list = [monster.to_dict() for monster in monster_list]
-        return dict(
+        monster_basic_info_list = yield self.run_query(
+            self.query_page, user.user_id, params['limit'], params['offset'], params['after'],
+            params['fields'], params['include'])
+        next_after = None
+        if len(monster_basic_info_list) == params['limit']:
+            next_after = monster_basic_info_list[-1]['monster_id']
+        raise tornado.gen.Return(dict(
             success=True,
             reason='ok',
+            next_after=next_after,
             data=monster_basic_info_list
-        )
\ No newline at end of file
+        ))
+
+    @tornado.gen.coroutine
+    def stream_monster_basic_info_list(self, params):
+        """
+        write the list chunk by chunk, paging with after so that
+        neither the rows nor the response are ever held as a whole
+        """
+        user_result = yield self.get_user()
+        if not user_result['success']:
+            self.write(user_result)
+            return
+        user_id = user_result['user'].user_id
+
+        chunk_size = configs.monster_list_stream_chunk_size
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write('{"success": true, "reason": "ok", "data": [')
+        after = params['after']
+        separator = ''
+        while True:
+            chunk = yield self.run_query(
+                self.query_page, user_id, chunk_size, params['offset'], after,
+                params['fields'], params['include'])
+            if chunk:
+                with self.timing.measure('serialize'):
+                    text = separator + ', '.join(json.dumps(fields) for fields in chunk)
+                self.write(text)
+                separator = ', '
+                after = chunk[-1]['monster_id']
+                yield self.flush()
+            if len(chunk) < chunk_size:
+                break
+        self.write(']}')
+
+
+@mapping('/metrics')
+class PageMetrics(PageBase):
+    """
+    PageMetrics
+
+    request timings of this process in the prometheus text format, see core.metrics
+
+    method: get
+    no param
+    """
+    preload_current_user = False
+
+    def __init__(self, application, request, **kwargs):
+        PageBase.__init__(self, application, request, **kwargs)
+
+    def get(self):
+        if not configs.metrics_enabled:
+            raise tornado.web.HTTPError(404)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.Metrics.instance().render())
+
+
+@mapping('/api/admin/profile')
+class APIAdminProfile(PageBase):
+    """
+    APIAdminProfile
+
+    api to profile this process for a while, for administrators only
+    samples are attributed to the mapped path of the handler they ran for,
+    IOLoop samples only while metrics_enabled is set
+
+    method: get
+    param seconds: float    (profiler_default_seconds by default, at most profiler_max_seconds)
+    param interval_ms: float (profiler_interval_ms by default)
+    param idle: bool        (include threads waiting for work)
+    param format: "collapsed" | "json"
+    result:
+    collapsed stacks, "<thread>;<path>;<frame>;... <count>" per line, for flamegraph.pl
+    or
+    {
+      interval: float,
+      seconds: float,
+      samples: int,
+      idle: int,
+      handlers: {path: count},
+      stacks: {stack: count}
+    }
+    """
+    ADMIN_ROLE_IDS = (1, 2)
+
+    def __init__(self, application, request, **kwargs):
+        PageBase.__init__(self, application, request, **kwargs)
+
+    @tornado.gen.coroutine
+    def get(self):
+        if not configs.profiler_enabled:
+            raise tornado.web.HTTPError(404)
+        user = None
+        if self.current_user:
+            # the role in the user_identity cookie may be days old
+            user_id = self.current_user.user_id
+            user = yield self.run_query(lambda db: db.query(User).filter(User.user_id == user_id).first())
+        if user is None or user.user_role_id not in self.ADMIN_ROLE_IDS:
+            self.set_status(403)
+            self.write(dict(success=False, reason='administrators only.'))
+            return
+        try:
+            seconds = float(self.get_argument('seconds', configs.profiler_default_seconds))
+            interval = float(self.get_argument('interval_ms', configs.profiler_interval_ms)) / 1000.0
+            # comparisons with nan are false, so it fails here too
+            if not (0 < seconds < float('inf') and 0 < interval < float('inf')):
+                raise ValueError()
+        except ValueError:
+            self.set_status(400)
+            self.write(dict(success=False, reason='illegal param "seconds" or "interval_ms".'))
+            return
+        seconds = min(seconds, configs.profiler_max_seconds)
+        interval = max(interval, 0.001)
+        include_idle = self.get_argument('idle', 'false').lower() not in ('false', '0', '')
+        handler_names = dict((page.__name__, path) for path, page in page_dict.iteritems())
+        future = Profiler.instance().start(seconds, interval, handler_names, include_idle)
+        if future is None:
+            self.set_status(409)
+            self.write(dict(success=False, reason='a profile is already being taken.'))
+            return
+        profile = yield future
+        if self.get_argument('format', 'collapsed') == 'json':
+            self.write(profile.to_dict())
+        else:
+            self.set_header('Content-Type', 'text/plain; charset=utf-8')
+            self.write(profile.collapsed())
@@ -7,10 +7,241 @@ SocketPage
 
 __author__ = 'Rnd495'
 
+import json
+import time
+import struct
+
+import tornado.gen
+import tornado.ioloop
+import tornado.web
 import tornado.websocket
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
 
-import core.models
+from core.models import Monster
 from core.configs import Configs
 from UI.Manager import mapping
+from UI.Page import UserCookieMixin
+
+configs = Configs.instance()
+
+
+def build_text_frame(data):
+    """
+    unmasked websocket text frame, the same bytes fit every uncompressed server side connection
+    :param data: utf-8 encoded str
+    :return: str
+    """
+    length = len(data)
+    if length < 126:
+        header = struct.pack("!BB", 0x81, length)
+    elif length <= 0xFFFF:
+        header = struct.pack("!BBH", 0x81, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x81, 127, length)
+    return header + data
+
+
+class TopicRegistry(object):
+    """
+    TopicRegistry
+    subscribers of topics, e.g. "user:1"
+    a published message is serialized and framed once, the same bytes are
+    written to every subscriber without compression
+    subscribers with max_pending writes still in flight miss messages,
+    and are closed once they missed max_pending in a row
+    must be used on the IOLoop, see publish_threadsafe
+    """
+    def __init__(self, max_pending=100):
+        object.__init__(self)
+        self.max_pending = max_pending
+        self.topics = {}
+        # loop of the subscribers, set by subscribe
+        self.io_loop = None
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def subscribe(self, topic, subscriber):
+        self.io_loop = tornado.ioloop.IOLoop.current()
+        self.topics.setdefault(topic, set()).add(subscriber)
+
+    def unsubscribe(self, topic, subscriber):
+        subscribers = self.topics.get(topic, None)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.topics[topic]
+
+    def unsubscribe_all(self, subscriber):
+        for topic in list(subscriber.topics):
+            self.unsubscribe(topic, subscriber)
+
+    def publish(self, topic, data):
+        """
+        :param data: json serializable, sent as {"topic": topic, "data": data}
+        :return: count of subscribers written to
+        """
+        subscribers = self.topics.get(topic, None)
+        if not subscribers:
+            return 0
+        message = json.dumps(dict(topic=topic, data=data))
+        frame = build_text_frame(message)
+        self.published += 1
+        delivered = 0
+        for subscriber in list(subscribers):
+            if subscriber.pending >= self.max_pending:
+                self.dropped += 1
+                subscriber.missed += 1
+                if subscriber.missed >= self.max_pending:
+                    subscriber.close(1013, 'too slow')
+                continue
+            if subscriber.send(message, frame):
+                delivered += 1
+        self.delivered += delivered
+        return delivered
+
+    def publish_threadsafe(self, topic, data):
+        """
+        publish from any thread, e.g. the database pool
+        """
+        if self.io_loop is not None:
+            self.io_loop.add_callback(self.publish, topic, data)
+
+    def stats(self):
+        return dict(topics=len(self.topics), subscriptions=sum(len(s) for s in self.topics.itervalues()),
+                    published=self.published, delivered=self.delivered, dropped=self.dropped)
+
+    @classmethod
+    def instance(cls):
+        if not hasattr(cls, '__instance__'):
+            cls.__instance__ = cls(configs.websocket_max_pending_messages)
+        return cls.__instance__
+
+
+def _queue_monster_event(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('monster_events', []).append(
+            (target.monster_owner_id, target.to_dict()))
+
+
+def _publish_monster_events(session):
+    for owner_id, fields in session.info.pop('monster_events', ()):
+        TopicRegistry.instance().publish_threadsafe('user:%s' % owner_id, dict(type='monster', monster=fields))
+
+
+def _drop_monster_events(session):
+    session.info.pop('monster_events', None)
+
+
+# monster changes reach the owner's channel once committed
+for _event_name in ('after_insert', 'after_update'):
+    event.listen(Monster, _event_name, _queue_monster_event)
+event.listen(Session, 'after_commit', _publish_monster_events)
+event.listen(Session, 'after_rollback', _drop_monster_events)
+
+
+@mapping('/socket')
+class SocketGameChannel(UserCookieMixin, tornado.websocket.WebSocketHandler):
+    """
+    SocketGameChannel
+
+    real time channel of the logged in user
+    the channel is subscribed to "user:<user_id>" on open,
+    monster changes of the user are published there
+
+    messages from the client:
+    {action: "subscribe" | "unsubscribe", topic: str}   (topic "user:<own id>" only)
+    {action: "ping"}
+    messages to the client:
+    {topic: str, data: object}
+    {error: str}
+    """
+    def __init__(self, application, request, **kwargs):
+        tornado.websocket.WebSocketHandler.__init__(self, application, request, **kwargs)
+        self.topics = set()
+        self.pending = 0
+        self.missed = 0
+        # set in open, whether messages go through permessage-deflate
+        self.compressed = False
+
+    @tornado.gen.coroutine
+    def prepare(self):
+        current_user = yield self.load_current_user()
+        if current_user is None:
+            raise tornado.web.HTTPError(403)
+        self.current_user = current_user
+
+    def get_compression_options(self):
+        # permessage-deflate is used when the client offers it
+        if not configs.websocket_compression:
+            return None
+        return dict(compression_level=configs.websocket_compression_level)
+
+    def open(self):
+        # tornado deflates exactly when it offers compression options and the client asked for it
+        self.compressed = self.get_compression_options() is not None and \
+            'permessage-deflate' in self.request.headers.get('Sec-WebSocket-Extensions', '')
+        self.subscribe('user:%s' % self.current_user.user_id)
+
+    def subscribe(self, topic):
+        self.topics.add(topic)
+        TopicRegistry.instance().subscribe(topic, self)
+
+    def unsubscribe(self, topic):
+        self.topics.discard(topic)
+        TopicRegistry.instance().unsubscribe(topic, self)
+
+    def can_subscribe(self, topic):
+        # other users' channels are private, add topics here together with their publisher
+        return topic == 'user:%s' % self.current_user.user_id
+
+    def on_message(self, message):
+        try:
+            message = json.loads(message)
+            action = message['action']
+        except (ValueError, TypeError, KeyError):
+            self.send_json(dict(error='illegal message.'))
+            return
+        if action in ('subscribe', 'unsubscribe'):
+            topic = message.get('topic', None)
+            if not isinstance(topic, basestring) or not self.can_subscribe(topic):
+                self.send_json(dict(error='illegal topic "%s".' % topic))
+            elif action == 'subscribe':
+                self.subscribe(topic)
+            else:
+                self.unsubscribe(topic)
+        elif action == 'ping':
+            self.send_json(dict(pong=time.time()))
+        else:
+            self.send_json(dict(error='unknown action "%s".' % action))
+
+    def send_json(self, data):
+        message = json.dumps(data)
+        self.send(message, build_text_frame(message))
+
+    def send(self, message, frame):
+        """
+        write a message, as the prebuilt frame when the connection is not compressed
+        :return: False when the connection is closed
+        """
+        connection = self.ws_connection
+        if connection is None or connection.stream is None or connection.stream.closed():
+            return False
+        if not self.compressed:
+            future = connection.stream.write(frame)
+        else:
+            future = self.write_message(message)
+        self.pending += 1
+        self.missed = 0
+        future.add_done_callback(self.on_sent)
+        return True
+
+    def on_sent(self, future):
+        self.pending -= 1
+        # a closed stream fails the write, nothing to do about it here
+        future.exception()
 
-configs = Configs.instance()
\ No newline at end of file
+    def on_close(self):
+        TopicRegistry.instance().unsubscribe_all(self)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+benchmarks
+run from the project root, e.g. "python -m benchmarks.bench_verification"
+"""
+
+__author__ = 'Rnd495'
+
+import time
+
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
+import tornado.testing
+
+
+def timeit(name, function, count, unit):
+    """
+    run function once and print its rate
+    :param count: count of units function handles
+    :param unit: plural name of them, e.g. "rows"
+    """
+    begin = time.time()
+    function()
+    cost = time.time() - begin
+    print "%-24s %8.3fs  %12.0f %s/sec" % (name, cost, count / cost, unit)
+
+
+def start_app_server(app):
+    """
+    serve app on an unused local port of the current IOLoop, without access logs
+    :return: base url, e.g. "http://127.0.0.1:8888"
+    """
+    app.settings['log_function'] = lambda handler: None
+    sock, port = tornado.testing.bind_unused_port()
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets([sock])
+    return 'http://127.0.0.1:%d' % port
+
+
+@tornado.gen.coroutine
+def login(base_url, username=None, password=None):
+    """
+    log in through /api/user/login, as the configured admin by default
+    :return: value for the Cookie header
+    """
+    from core.configs import Configs
+    configs = Configs.instance()
+    client = tornado.httpclient.AsyncHTTPClient()
+    response = yield client.fetch('%s/api/user/login?username=%s&password=%s' % (
+        base_url, username or configs.init_admin_username, password or configs.init_admin_password))
+    cookies = [header.split(';')[0] for header in response.headers.get_list('Set-Cookie')]
+    raise tornado.gen.Return('; '.join(cookies))
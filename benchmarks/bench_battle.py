@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+benchmarks.bench_battle
+battles/sec of core.battle in the scalar, batch and process pool modes
+fighters are random, the element matrix comes from the configured database
+"""
+
+__author__ = 'Rnd495'
+
+import random
+
+from benchmarks import timeit
+
+
+def random_fighter(rnd, size):
+    from core.battle import Fighter, Move
+    moves = [Move(rnd.choice((40, 60, 80, 100)), rnd.choice((70, 85, 100)),
+                  rnd.randint(1, size - 1), rnd.random() < 0.5)
+             for _ in range(rnd.randint(1, 4))]
+    return Fighter(hp=rnd.randint(100, 300), atk=rnd.randint(20, 120), def_=rnd.randint(20, 120),
+                   spd=rnd.randint(20, 120), sp_atk=rnd.randint(20, 120), sp_def=rnd.randint(20, 120),
+                   element_id=rnd.randint(1, size - 1), level=rnd.randint(1, 100), moves=moves)
+
+
+def main():
+    from tornado.options import options, define
+    define("count", default=20000, help="count of battles", type=int)
+    define("scalar_count", default=2000, help="count of battles in the scalar mode", type=int)
+    define("chunk_size", default=4096, help="battles per process pool task", type=int)
+    define("processes", default=0, help="process pool size, 0 means one per cpu", type=int)
+    options.parse_command_line()
+
+    from concurrent.futures import ProcessPoolExecutor
+    from core import models, models_init, battle
+    from core.elements import ElementMatrix
+    models_init.init()
+    matrix = ElementMatrix()
+    models.run_in_session(matrix.load)
+    size = matrix.stats()['size']
+    rnd = random.Random(0)
+    fighters_a = [random_fighter(rnd, size) for _ in range(options.count)]
+    fighters_b = [random_fighter(rnd, size) for _ in range(options.count)]
+    side_a = battle.FighterArrays.from_fighters(fighters_a)
+    side_b = battle.FighterArrays.from_fighters(fighters_b)
+
+    def scalar():
+        for i in range(options.scalar_count):
+            battle.simulate(fighters_a[i], fighters_b[i], matrix, seed=i)
+
+    executor = ProcessPoolExecutor(max_workers=options.processes or None)
+    try:
+        # start the workers before timing
+        battle.simulate_batch_parallel(side_a.slice(0, 8), side_b.slice(0, 8), matrix, 0, chunk_size=1,
+                                       executor=executor)
+        timeit('scalar', scalar, options.scalar_count, 'battles')
+        timeit('batch', lambda: battle.simulate_batch(side_a, side_b, matrix, seed=0), options.count, 'battles')
+        timeit('batch process pool', lambda: battle.simulate_batch_parallel(
+            side_a, side_b, matrix, seed=0, chunk_size=options.chunk_size, executor=executor),
+            options.count, 'battles')
+    finally:
+        executor.shutdown()
+    winner, turns, _, _ = battle.simulate_batch(side_a, side_b, matrix, seed=0)
+    print "a won %d, b won %d, draws %d, mean turns %.2f" % (
+        (winner == 0).sum(), (winner == 1).sum(), (winner == -1).sum(), turns.mean())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+benchmarks.bench_database
+throughput of slow queries run on the IOLoop against queries run in a
+thread pool, the way PageBase.run_query does
+slow queries are simulated with a sqlite "sleep(ms)" function
+"""
+
+__author__ = 'Rnd495'
+
+import os
+import time
+import tempfile
+
+import tornado.gen
+import tornado.web
+import tornado.ioloop
+import tornado.httpclient
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, event
+from tornado.options import options, define
+
+from benchmarks import start_app_server
+
+
+def create_sleepy_engine(path):
+    engine = create_engine('sqlite:///' + path)
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.create_function('sleep', 1, lambda ms: time.sleep(ms / 1000.0) or 0)
+    return engine
+
+
+class SyncQueryHandler(tornado.web.RequestHandler):
+    def initialize(self, engine, executor):
+        self.engine = engine
+
+    def get(self):
+        self.write({'result': self.engine.execute('SELECT sleep(?)', options.query_ms).scalar()})
+
+
+class ThreadPoolQueryHandler(tornado.web.RequestHandler):
+    def initialize(self, engine, executor):
+        self.engine = engine
+        self.executor = executor
+
+    @tornado.gen.coroutine
+    def get(self):
+        result = yield self.executor.submit(
+            lambda: self.engine.execute('SELECT sleep(?)', options.query_ms).scalar())
+        self.write({'result': result})
+
+
+@tornado.gen.coroutine
+def drive(url, count):
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=options.concurrency)
+    begin = time.time()
+    yield [client.fetch(url, request_timeout=600) for _ in range(count)]
+    raise tornado.gen.Return(count / (time.time() - begin))
+
+
+def main():
+    define("requests", default=200, help="requests per case", type=int)
+    define("concurrency", default=32, help="concurrent requests", type=int)
+    define("query_ms", default=20, help="simulated query time in ms", type=int)
+    define("executor_size", default=8, help="database executor threads", type=int)
+    options.parse_command_line()
+
+    path = tempfile.mktemp(suffix='.sqlite3')
+    engine = create_sleepy_engine(path)
+    executor = ThreadPoolExecutor(max_workers=options.executor_size)
+    kwargs = dict(engine=engine, executor=executor)
+    app = tornado.web.Application([
+        (r'/sync', SyncQueryHandler, kwargs),
+        (r'/thread_pool', ThreadPoolQueryHandler, kwargs),
+    ])
+    base_url = start_app_server(app)
+    io_loop = tornado.ioloop.IOLoop.current()
+    try:
+        for name in ('sync', 'thread_pool'):
+            url = '%s/%s' % (base_url, name)
+            rate = io_loop.run_sync(lambda: drive(url, options.requests))
+            print "%-12s %8.1f req/sec  (query %dms, concurrency %d, executor %d)" % (
+                name, rate, options.query_ms, options.concurrency, options.executor_size)
+    finally:
+        executor.shutdown()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
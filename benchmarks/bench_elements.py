@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+benchmarks.bench_elements
+element effect lookups through the ORM against core.elements.ElementMatrix
+needs a configured database, seeded by core.models_init.init
+"""
+
+__author__ = 'Rnd495'
+
+import random
+
+from benchmarks import timeit
+
+
+def main():
+    from tornado.options import options, define
+    define("count", default=100000, help="count of lookups", type=int)
+    define("orm_count", default=2000, help="count of lookups through the ORM", type=int)
+    options.parse_command_line()
+
+    from core import models, models_init
+    from core.elements import ElementMatrix
+    models_init.init()
+    session = models.get_new_session()
+    matrix = ElementMatrix()
+    matrix.load(session)
+    size = matrix.stats()['size']
+    rnd = random.Random(0)
+    pairs = [(rnd.randint(1, size - 1), rnd.randint(1, size - 1)) for _ in range(options.count)]
+    atk_ids = [atk for atk, _ in pairs]
+    def_ids = [dfn for _, dfn in pairs]
+    def_ids_2 = [rnd.randint(0, size - 1) for _ in range(options.count)]
+
+    def orm():
+        ElementVSElement = models.ElementVSElement
+        for atk, dfn in pairs[:options.orm_count]:
+            session.query(ElementVSElement.effect).filter(
+                ElementVSElement.atk_element_id == atk,
+                ElementVSElement.def_element_id == dfn).scalar()
+
+    def scalar():
+        multiplier = matrix.multiplier
+        for atk, dfn in pairs:
+            multiplier(atk, dfn)
+
+    timeit('orm query', orm, options.orm_count, 'lookups')
+    timeit('multiplier', scalar, options.count, 'lookups')
+    timeit('multipliers', lambda: matrix.multipliers(atk_ids, def_ids), options.count, 'lookups')
+    timeit('multipliers dual', lambda: matrix.multipliers(atk_ids, def_ids, def_ids_2), options.count, 'lookups')
+    print matrix.stats()
+    session.close()
+
+
+if __name__ == '__main__':
+    main()
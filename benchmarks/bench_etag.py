@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+benchmarks.bench_etag
+a polling client of the JSON apis with and without If-None-Match
+reports bytes and cpu time per poll
+runs create_app() against the configured database, monsters are added
+to the polling user for the run and removed afterwards
+"""
+
+__author__ = 'Rnd495'
+
+import os
+import time
+
+import tornado.gen
+import tornado.ioloop
+import tornado.httpclient
+from tornado.options import options, define
+
+from benchmarks import login, start_app_server
+
+
+@tornado.gen.coroutine
+def check_pages(base_url, cookie):
+    """
+    two pages of the same list must not share an ETag
+    """
+    client = tornado.httpclient.AsyncHTTPClient()
+    url = base_url + '/api/user/has_monster/basic_info/list?limit=1&offset=%d'
+    first = yield client.fetch(url % 0, headers={'Cookie': cookie})
+    second = yield client.fetch(url % 1, headers={'Cookie': cookie, 'If-None-Match': first.headers['Etag']},
+                                raise_error=False)
+    assert second.code == 200 and second.headers['Etag'] != first.headers['Etag'], \
+        'page 2 answered %d with the ETag of page 1' % second.code
+
+
+@tornado.gen.coroutine
+def poll(url, cookie, count, conditional):
+    """
+    poll url count times, sending back the last ETag when conditional
+    :return: (polls/sec, body bytes per poll, cpu ms per poll)
+    """
+    client = tornado.httpclient.AsyncHTTPClient()
+    etag = None
+    received = 0
+    cpu = sum(os.times()[:2])
+    begin = time.time()
+    for _ in range(count):
+        headers = {'Cookie': cookie}
+        if conditional and etag:
+            headers['If-None-Match'] = etag
+        response = yield client.fetch(url, headers=headers, raise_error=False)
+        assert response.code in (200, 304), response.code
+        etag = response.headers.get('Etag', etag)
+        received += len(response.body or '')
+    cost = time.time() - begin
+    cpu = sum(os.times()[:2]) - cpu
+    raise tornado.gen.Return((count / cost, float(received) / count, cpu * 1000 / count))
+
+
+def main():
+    define("polls", default=500, help="polls per case", type=int)
+    define("monsters", default=200, help="monsters of the polling user", type=int)
+    options.parse_command_line()
+
+    import core.models
+    from core.models import Monster
+    from UI.Manager import create_app
+
+    app = create_app()
+    base_url = start_app_server(app)
+    io_loop = tornado.ioloop.IOLoop.current()
+    cookie = io_loop.run_sync(lambda: login(base_url))
+    user_id = core.models.run_in_session(
+        lambda db: db.query(core.models.User.user_id).filter(
+            core.models.User.user_name == core.models.configs.init_admin_username).scalar())
+
+    def add_monsters(db):
+        monsters = [Monster(monster_name='bench %d' % i, monster_hp=100, monster_level=i % 100,
+                            monster_owner_id=user_id) for i in range(options.monsters)]
+        db.add_all(monsters)
+        db.flush()
+        return [monster.monster_id for monster in monsters]
+    monster_ids = core.models.run_in_session(add_monsters)
+    try:
+        io_loop.run_sync(lambda: check_pages(base_url, cookie))
+        for path in ('/api/user/basic_info', '/api/user/has_monster/basic_info/list?limit=500'):
+            for conditional in (False, True):
+                rate, size, cpu = io_loop.run_sync(lambda: poll(base_url + path, cookie, options.polls, conditional))
+                print "%-50s %-14s %8.1f polls/sec  %8.0f bytes/poll  %6.3f cpu ms/poll" % (
+                    path, 'If-None-Match' if conditional else 'plain', rate, size, cpu)
+    finally:
+        core.models.run_in_session(
+            lambda db: db.query(Monster).filter(Monster.monster_id.in_(monster_ids)).delete(synchronize_session=False))
+
+
+if __name__ == '__main__':
+    main()
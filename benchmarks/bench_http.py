@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+benchmarks.bench_http
+load test of the pages and apis
+
+create_app() runs in a child process against a temporary sqlite database,
+with the schema of the configured database, seeded by core.models_init.init
+and options.monsters monsters of the admin
+every scenario is driven at options.concurrency concurrent requests,
+reporting req/sec, latency percentiles and how long the IOLoop of the
+server was blocked, measured in the server process
+
+results are stored as json under options.output_dir, compare two commits with
+    python -m benchmarks.bench_http --compare=benchmarks/results/<earlier>.json
+"""
+
+__author__ = 'Rnd495'
+
+import os
+import sys
+import json
+import time
+import signal
+import tempfile
+import datetime
+import subprocess
+
+import tornado.gen
+import tornado.web
+import tornado.ioloop
+import tornado.httpclient
+import tornado.httpserver
+import tornado.testing
+from tornado.options import options, define
+
+
+class LoopLagMonitor(object):
+    """
+    LoopLagMonitor
+    a callback every interval seconds, how late it runs is how long the IOLoop was blocked
+    """
+    def __init__(self, interval=0.005):
+        object.__init__(self)
+        self.interval = interval
+        self.callback = tornado.ioloop.PeriodicCallback(self.tick, interval * 1000)
+        self.reset()
+
+    def reset(self):
+        self.begin = self.expected = time.time() + self.interval
+        self.blocked = 0.0
+        self.max_lag = 0.0
+
+    def start(self):
+        self.reset()
+        self.callback.start()
+
+    def tick(self):
+        now = time.time()
+        lag = max(now - self.expected, 0.0)
+        self.blocked += lag
+        self.max_lag = max(self.max_lag, lag)
+        self.expected = now + self.interval
+
+    def stats(self):
+        elapsed = max(time.time() - self.begin, 1e-9)
+        return dict(blocked_ms=round(self.blocked * 1000, 1), max_lag_ms=round(self.max_lag * 1000, 1),
+                    blocked_ratio=round(self.blocked / elapsed, 4))
+
+
+class LoopStatsHandler(tornado.web.RequestHandler):
+    """
+    lag of the server IOLoop since the last call
+    """
+    def initialize(self, monitor):
+        self.monitor = monitor
+
+    def get(self):
+        self.write(self.monitor.stats())
+        self.monitor.reset()
+
+
+# (name, path, logged in)
+SCENARIOS = [
+    ('login page', '/login', False),
+    ('register page', '/register', False),
+    ('create verification code', '/api/create_verification_code', False),
+    ('check verification code', None, False),
+    ('api user login', None, False),
+    ('api basic info', '/api/user/basic_info', True),
+    ('monster list', '/api/user/has_monster/basic_info/list', True),
+]
+
+
+def get_path(name, path, context, index):
+    if name == 'check verification code':
+        # codes created by the previous scenario, checked with a wrong answer so none is used up twice
+        return '/api/check_verification_code?ver_uuid=%s&ver_code=0000' % (
+            context['uuids'][index % len(context['uuids'])] if context['uuids'] else 'none')
+    if name == 'api user login':
+        return '/api/user/login?username=%s&password=%s' % (context['username'], context['password'])
+    return path
+
+
+def on_response(name, response, context):
+    if name == 'create verification code' and response.code == 200:
+        context['uuids'].append(json.loads(response.body)['uuid'])
+
+
+def create_database(path):
+    """
+    copy the schema of the configured database to a new sqlite database at path
+    """
+    from sqlalchemy import create_engine
+    from sqlalchemy.schema import MetaData
+    from core import schema_snapshot
+    from core.configs import Configs
+    meta = schema_snapshot.load()
+    if not meta.tables:
+        meta = MetaData()
+        meta.reflect(bind=create_engine(Configs.instance().database_url))
+    # tables sqlite keeps for itself are left to it
+    tables = [table for table in meta.sorted_tables if not table.name.startswith('sqlite_')]
+    meta.create_all(create_engine('sqlite:///' + path), tables=tables)
+
+
+def seed_monsters(session, owner_id, count):
+    import core.models
+    for i in range(count):
+        session.add(core.models.Monster(monster_name='monster%d' % i, monster_hp=100 + i % 50,
+                                        monster_element_id=1 + i % 3, monster_owner_id=owner_id))
+
+
+def serve(sock):
+    """
+    runs in the child process
+    """
+    import core.models
+    from core.configs import Configs
+    from UI.Manager import create_app
+    configs = Configs.instance()
+    app = create_app()
+    app.settings['log_function'] = lambda handler: None
+    admin = core.models.run_in_session(
+        lambda db: db.query(core.models.User).filter(core.models.User.user_name == configs.init_admin_username).one())
+    core.models.run_in_session(seed_monsters, admin.user_id, options.monsters)
+    monitor = LoopLagMonitor()
+    app.add_handlers(r'.*', [(r'/_bench/loop', LoopStatsHandler, dict(monitor=monitor))])
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets([sock])
+    monitor.start()
+    tornado.ioloop.IOLoop.current().start()
+
+
+@tornado.gen.coroutine
+def run_scenario(base_url, name, path, cookie, context):
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=options.concurrency)
+    headers = {'Cookie': cookie} if cookie else {}
+    latencies = []
+    errors = [0]
+    counter = iter(xrange(options.requests))
+
+    @tornado.gen.coroutine
+    def worker():
+        for index in counter:
+            begin = time.time()
+            response = yield client.fetch(base_url + get_path(name, path, context, index), headers=headers,
+                                          follow_redirects=False, raise_error=False, request_timeout=600)
+            latencies.append(time.time() - begin)
+            if response.code >= 400 or response.code < 200:
+                errors[0] += 1
+            on_response(name, response, context)
+    yield client.fetch(base_url + '/_bench/loop')
+    begin = time.time()
+    yield [worker() for _ in range(options.concurrency)]
+    elapsed = time.time() - begin
+    loop = yield client.fetch(base_url + '/_bench/loop')
+    latencies.sort()
+
+    def percentile(q):
+        return round(latencies[int(round(q * (len(latencies) - 1)))] * 1000, 2)
+    result = dict(requests=len(latencies), errors=errors[0], rate=round(len(latencies) / elapsed, 1),
+                  p50_ms=percentile(0.5), p95_ms=percentile(0.95), p99_ms=percentile(0.99),
+                  max_ms=round(latencies[-1] * 1000, 2))
+    result.update(json.loads(loop.body))
+    raise tornado.gen.Return(result)
+
+
+@tornado.gen.coroutine
+def wait_until_ready(base_url, timeout=60):
+    client = tornado.httpclient.AsyncHTTPClient()
+    deadline = time.time() + timeout
+    while True:
+        try:
+            yield client.fetch(base_url + '/_bench/loop')
+            return
+        except Exception:
+            if time.time() > deadline:
+                raise
+            yield tornado.gen.sleep(0.2)
+
+
+@tornado.gen.coroutine
+def login(base_url, context):
+    client = tornado.httpclient.AsyncHTTPClient()
+    response = yield client.fetch(base_url + get_path('api user login', None, context, 0))
+    cookies = [header.split(';')[0] for header in response.headers.get_list('Set-Cookie')]
+    raise tornado.gen.Return('; '.join(cookies))
+
+
+@tornado.gen.coroutine
+def bench(base_url, context):
+    yield wait_until_ready(base_url)
+    cookie = yield login(base_url, context)
+    selected = set(options.scenarios.split(',')) if options.scenarios else None
+    results = {}
+    for name, path, logged_in in SCENARIOS:
+        if selected is not None and name not in selected:
+            continue
+        results[name] = yield run_scenario(base_url, name, path, cookie if logged_in else None, context)
+        print_result(name, results[name])
+    raise tornado.gen.Return(results)
+
+
+def print_result(name, result, previous=None):
+    line = "%-26s %8.1f req/sec  p50 %7.2f  p95 %7.2f  p99 %7.2f ms  blocked %6.1f%%  max lag %7.1f ms" % (
+        name, result['rate'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+        result['blocked_ratio'] * 100, result['max_lag_ms'])
+    if result['errors']:
+        line += "  %d errors" % result['errors']
+    if previous is not None:
+        line += "  (req/sec %+.1f%%, p95 %+.1f%%)" % (
+            (result['rate'] / previous['rate'] - 1) * 100 if previous['rate'] else 0,
+            (result['p95_ms'] / previous['p95_ms'] - 1) * 100 if previous['p95_ms'] else 0)
+    print line
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    define("requests", default=500, help="requests per scenario", type=int)
+    define("concurrency", default=16, help="concurrent requests", type=int)
+    define("monsters", default=200, help="monsters of the admin in the seeded database", type=int)
+    define("scenarios", default="", help="comma separated scenario names, all by default", type=str)
+    define("output_dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results'),
+           help="where the json results are stored, empty to skip", type=str)
+    define("compare", default="", help="json results of an earlier run to compare with", type=str)
+    options.parse_command_line()
+
+    from core.configs import Configs
+    configs = Configs.instance()
+    database_path = tempfile.mktemp(suffix='.sqlite3')
+    try:
+        create_database(database_path)
+    except:
+        if os.path.exists(database_path):
+            os.remove(database_path)
+        raise
+    # the child inherits the overridden configs
+    configs.database_url = 'sqlite:///' + database_path
+    configs.database_schema_snapshot = ''
+    context = dict(uuids=[], username=configs.init_admin_username, password=configs.init_admin_password)
+
+    sock, port = tornado.testing.bind_unused_port()
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            # a group of its own, the pool processes of the server go down with it
+            os.setpgid(0, 0)
+            serve(sock)
+        except:
+            import traceback
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+    sock.close()
+    try:
+        results = tornado.ioloop.IOLoop.current().run_sync(
+            lambda: bench('http://127.0.0.1:%d' % port, context), timeout=3600)
+    finally:
+        os.killpg(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        os.remove(database_path)
+
+    report = dict(commit=get_commit(), time=datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                  python=sys.version.split()[0], requests=options.requests, concurrency=options.concurrency,
+                  monsters=options.monsters, results=results)
+    if options.compare:
+        with open(options.compare, 'rb') as f:
+            earlier = json.load(f)
+        print "compared with %s (%s)" % (earlier.get('commit'), earlier.get('time'))
+        for name, result in sorted(results.iteritems()):
+            if name in earlier['results']:
+                print_result(name, result, earlier['results'][name])
+    if options.output_dir:
+        if not os.path.isdir(options.output_dir):
+            os.makedirs(options.output_dir)
+        path = os.path.join(options.output_dir, '%s-%s.json' % (
+            report['time'].replace(':', '').replace('-', ''), report['commit'] or 'unknown'))
+        with open(path, 'wb') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print "results stored in", path
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+benchmarks.bench_models
+serialization of Monster rows with _Base.to_dict / _Base.to_dicts
+needs a configured database, objects are built in memory only
+"""
+
+__author__ = 'Rnd495'
+
+import datetime
+
+from benchmarks import timeit
+
+
+def legacy_to_dict(model):
+    """
+    the dir() based to_dict, kept here for comparison
+    """
+    from core.models import Base
+    fields = {}
+    for field in dir(model):
+        if field.startswith('_') or field in ['metadata', 'DATETIME_FORMAT']:
+            continue
+        val = model.__getattribute__(field)
+        if callable(val):
+            continue
+        if isinstance(val, datetime.datetime):
+            val = val.strftime(model.DATETIME_FORMAT)
+        elif isinstance(val, Base):
+            val = val.to_dict()
+        fields[field] = val
+    return fields
+
+
+def main():
+    from tornado.options import options, define
+    define("count", default=10000, help="count of Monster objects", type=int)
+    options.parse_command_line()
+
+    from core.models import Monster
+    monsters = []
+    for i in range(options.count):
+        monster = Monster()
+        for column in Monster.__table__.columns:
+            setattr(monster, column.key, i)
+        monsters.append(monster)
+
+    # the legacy one also picks up relationships, e.g. Monster.element
+    columns = [column.key for column in Monster.__table__.columns]
+    legacy = legacy_to_dict(monsters[0])
+    assert dict((key, legacy[key]) for key in columns) == monsters[0].to_dict()
+    timeit('legacy to_dict', lambda: [legacy_to_dict(monster) for monster in monsters], options.count, 'rows')
+    timeit('to_dict', lambda: [monster.to_dict() for monster in monsters], options.count, 'rows')
+    timeit('to_dicts', lambda: Monster.to_dicts(monsters), options.count, 'rows')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+benchmarks.bench_password
+password verifications per second and IOLoop latency at several kdf costs
+verifying on the IOLoop against verifying in a process pool, the way
+UI.Page.PageLogin.login does
+"""
+
+__author__ = 'Rnd495'
+
+import time
+
+import tornado.gen
+import tornado.ioloop
+from concurrent.futures import ProcessPoolExecutor
+from tornado.options import options, define
+
+from core.password import PasswordHasher
+
+_hashers = {}
+
+
+def verify(algorithm, cost, password, encoded):
+    key = (algorithm, cost)
+    if key not in _hashers:
+        _hashers[key] = PasswordHasher(algorithm, cost, 'pepper')
+    return _hashers[key].verify(password, encoded)
+
+
+@tornado.gen.coroutine
+def measure_lag(state, interval=0.005):
+    """
+    sleeps interval repeatedly and records how late the IOLoop wakes it up
+    """
+    while not state['done']:
+        begin = time.time()
+        yield tornado.gen.sleep(interval)
+        state['lag'].append(time.time() - begin - interval)
+
+
+@tornado.gen.coroutine
+def run_case(algorithm, cost, executor):
+    encoded = PasswordHasher(algorithm, cost, 'pepper').encode('password')
+    state = dict(done=False, lag=[])
+    ticker = measure_lag(state)
+    yield tornado.gen.moment
+
+    @tornado.gen.coroutine
+    def login():
+        if executor is None:
+            result = verify(algorithm, cost, 'password', encoded)
+            yield tornado.gen.moment
+        else:
+            result = yield executor.submit(verify, algorithm, cost, 'password', encoded)
+        assert result
+
+    begin = time.time()
+    yield [login() for _ in range(options.logins)]
+    rate = options.logins / (time.time() - begin)
+    state['done'] = True
+    yield ticker
+    lag = sorted(state['lag']) or [0.0]
+    raise tornado.gen.Return((rate, lag[len(lag) // 2], lag[-1]))
+
+
+def main():
+    define("logins", default=64, help="logins per case", type=int)
+    define("algorithm", default="pbkdf2_sha256", help="pbkdf2_sha256 or scrypt")
+    define("costs", default=[10000, 50000, 100000, 200000], help="kdf costs to compare", type=int, multiple=True)
+    define("processes", default=2, help="password pool processes", type=int)
+    options.parse_command_line()
+
+    executor = ProcessPoolExecutor(max_workers=options.processes)
+    io_loop = tornado.ioloop.IOLoop.current()
+    try:
+        # start the workers before timing
+        list(executor.map(verify, *zip(*[(options.algorithm, 1000, 'x', 'x')] * options.processes)))
+        for cost in options.costs:
+            for name, pool in (('ioloop', None), ('process_pool', executor)):
+                rate, lag_median, lag_max = io_loop.run_sync(
+                    lambda: run_case(options.algorithm, cost, pool))
+                print "%-14s cost %-7d %8.1f logins/sec  loop lag median %7.2fms max %8.2fms" % (
+                    name, cost, rate, lag_median * 1000, lag_max * 1000)
+    finally:
+        executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+benchmarks.bench_processes
+throughput of main.py --processes=n for several n
+main.py runs against the configured database, load is generated by
+--clients processes of their own so the load generator is not the limit
+several workers need verification_store = "sqlite" in the config
+"""
+
+__author__ = 'Rnd495'
+
+import os
+import sys
+import time
+import signal
+import subprocess
+import multiprocessing
+
+import tornado.gen
+import tornado.ioloop
+import tornado.httpclient
+import tornado.testing
+from tornado.options import options, define
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def generate_load(args):
+    url, requests, concurrency = args
+
+    @tornado.gen.coroutine
+    def drive():
+        client = tornado.httpclient.AsyncHTTPClient(max_clients=concurrency)
+        responses = yield [client.fetch(url, raise_error=False) for _ in range(requests)]
+        raise tornado.gen.Return(sum(1 for response in responses if response.code != 200))
+    return tornado.ioloop.IOLoop.current().run_sync(drive)
+
+
+def wait_until_up(url, timeout=30):
+    client = tornado.httpclient.HTTPClient()
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            client.fetch(url)
+            return
+        except Exception:
+            time.sleep(0.2)
+    raise RuntimeError('RuntimeError: server did not start in %ds' % timeout)
+
+
+def main():
+    define("processes", default=[1, 2, 4], help="worker counts to compare", type=int, multiple=True)
+    define("clients", default=4, help="load generator processes", type=int)
+    define("requests", default=2000, help="requests per case", type=int)
+    define("concurrency", default=32, help="concurrent requests per load generator", type=int)
+    define("path", default="/api/catalog", help="path to request", type=str)
+    define("reuse_port", default=False, help="run main.py with --reuse_port", type=bool)
+    options.parse_command_line()
+
+    sock, port = tornado.testing.bind_unused_port()
+    sock.close()
+    url = 'http://127.0.0.1:%d%s' % (port, options.path)
+    generators = multiprocessing.Pool(options.clients)
+    try:
+        for processes in options.processes:
+            command = [sys.executable, 'main.py', '--port=%d' % port, '--ip=127.0.0.1',
+                       '--processes=%d' % processes, '--reuse_port=%s' % options.reuse_port,
+                       '--logging=warning']
+            server = subprocess.Popen(command, cwd=ROOT_PATH)
+            try:
+                wait_until_up(url)
+                # let every worker report ready
+                time.sleep(2)
+                per_client = options.requests // options.clients
+                begin = time.time()
+                errors = sum(generators.map(
+                    generate_load, [(url, per_client, options.concurrency)] * options.clients))
+                cost = time.time() - begin
+                print "processes %-3d %8.1f req/sec  %d errors" % (
+                    processes, per_client * options.clients / cost, errors)
+            finally:
+                server.send_signal(signal.SIGTERM)
+                server.wait()
+    finally:
+        generators.terminate()
+
+
+if __name__ == '__main__':
+    main()
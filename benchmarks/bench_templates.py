@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+benchmarks.bench_templates
+pages/sec of the login and home pages, and the time of their first render,
+with templates compiled on first use and no fragment cache
+against templates compiled at startup and the UIModule fragment cache
+runs create_app() against the configured database
+"""
+
+__author__ = 'Rnd495'
+
+import os
+import time
+
+import tornado.gen
+import tornado.web
+import tornado.ioloop
+import tornado.httpclient
+from tornado.options import options, define
+
+from benchmarks import login, start_app_server
+
+
+@tornado.gen.coroutine
+def fetch_once(url, cookie):
+    client = tornado.httpclient.AsyncHTTPClient()
+    begin = time.time()
+    yield client.fetch(url, headers={'Cookie': cookie}, follow_redirects=False)
+    raise tornado.gen.Return((time.time() - begin) * 1000)
+
+
+@tornado.gen.coroutine
+def drive(url, cookie, count):
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=options.concurrency)
+    begin = time.time()
+    yield [client.fetch(url, headers={'Cookie': cookie}, follow_redirects=False) for _ in range(count)]
+    raise tornado.gen.Return(count / (time.time() - begin))
+
+
+def main():
+    define("requests", default=1000, help="requests per page and case", type=int)
+    define("concurrency", default=16, help="concurrent requests", type=int)
+    options.parse_command_line()
+
+    from core.configs import Configs, ROOT_PATH
+    from UI.Manager import create_app, load_templates
+    from UI.Module import CachedUIModule
+    configs = Configs.instance()
+
+    app = create_app()
+    base_url = start_app_server(app)
+    io_loop = tornado.ioloop.IOLoop.current()
+    cookie = io_loop.run_sync(lambda: login(base_url))
+    template_path = os.path.join(ROOT_PATH, "template")
+    # warm what the first request pays for besides templates
+    for path, page_cookie in (('/login', ''), ('/', cookie)):
+        io_loop.run_sync(lambda: fetch_once(base_url + path, page_cookie))
+
+    cases = [
+        ('on first use', False, 0),
+        ('precompiled + cache', True, configs.ui_fragment_cache_size),
+    ]
+    for name, precompile, cache_size in cases:
+        # loaders are kept per template path by RequestHandler
+        tornado.web.RequestHandler._template_loaders.clear()
+        app.settings.pop('template_loader', None)
+        begin = time.time()
+        if precompile:
+            app.settings['template_loader'] = load_templates(template_path)
+        startup = (time.time() - begin) * 1000
+        CachedUIModule.fragment_cache.capacity = cache_size
+        CachedUIModule.fragment_cache.clear()
+        for path, page_cookie in (('/login', ''), ('/', cookie)):
+            first = io_loop.run_sync(lambda: fetch_once(base_url + path, page_cookie))
+            rate = io_loop.run_sync(lambda: drive(base_url + path, page_cookie, options.requests))
+            print "%-20s %-7s startup %6.1f ms  first render %6.1f ms  %8.1f pages/sec" % (
+                name, path, startup, first, rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+benchmarks.bench_user_cache
+database queries per request of an authenticated page
+without user cache, with user cache and with the identity cookie
+runs create_app() against the configured database
+"""
+
+__author__ = 'Rnd495'
+
+import time
+
+import tornado.gen
+import tornado.ioloop
+import tornado.httpclient
+from tornado.options import options, define
+
+from benchmarks import login, start_app_server
+
+
+@tornado.gen.coroutine
+def drive(url, cookie, count):
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=options.concurrency)
+    begin = time.time()
+    yield [client.fetch(url, headers={'Cookie': cookie}) for _ in range(count)]
+    raise tornado.gen.Return(count / (time.time() - begin))
+
+
+def main():
+    define("requests", default=500, help="requests per case", type=int)
+    define("concurrency", default=16, help="concurrent requests", type=int)
+    define("path", default="/", help="authenticated page to request", type=str)
+    define("username", default="", help="login username, init admin by default", type=str)
+    define("password", default="", help="login password, init admin by default", type=str)
+    options.parse_command_line()
+
+    from sqlalchemy import event
+    import core.models
+    from core.configs import Configs
+    from UI.Manager import create_app
+    configs = Configs.instance()
+
+    queries = [0]
+
+    @event.listens_for(core.models.get_engine(), 'before_cursor_execute')
+    def count_query(*args):
+        queries[0] += 1
+
+    app = create_app()
+    base_url = start_app_server(app)
+    io_loop = tornado.ioloop.IOLoop.current()
+
+    cache_size = configs.user_cache_size
+    cases = [
+        ('no cache', 0, False),
+        ('user cache', cache_size, False),
+        ('identity cookie', cache_size, True),
+    ]
+    for name, size, identity_cookie in cases:
+        core.models.user_cache.capacity = size
+        core.models.user_cache.clear()
+        core.models.user_cache.hits = core.models.user_cache.misses = 0
+        configs.user_identity_cookie = identity_cookie
+        cookie = io_loop.run_sync(lambda: login(base_url, options.username, options.password))
+        queries[0] = 0
+        rate = io_loop.run_sync(lambda: drive(base_url + options.path, cookie, options.requests))
+        print "%-16s %8.1f req/sec  %6.3f queries/request  cache hit ratio %.3f" % (
+            name, rate, float(queries[0]) / options.requests, core.models.user_cache.stats()['hit_ratio'])
+
+
+if __name__ == '__main__':
+    main()
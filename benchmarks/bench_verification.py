@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+benchmarks.bench_verification
+images/sec of Verification.render with and without the glyph atlas
+"""
+
+__author__ = 'Rnd495'
+
+import time
+
+
+def bench(verification, seconds):
+    count = 0
+    begin = time.time()
+    while time.time() - begin < seconds:
+        verification.render()
+        count += 1
+    return count / (time.time() - begin)
+
+
+def main():
+    from tornado.options import options, define
+    define("seconds", default=3.0, help="seconds per case", type=float)
+    define("noise", default=10, help="noise percent of the noise cases", type=int)
+    options.parse_command_line()
+
+    from core.verification import Verification
+    cases = [
+        ('resize+rotate', dict(use_atlas=False)),
+        ('atlas', dict(use_atlas=True)),
+        ('resize+rotate, palette', dict(use_atlas=False, image_palette=True)),
+        ('atlas, palette', dict(use_atlas=True, image_palette=True)),
+        ('atlas, palette, noise', dict(use_atlas=True, image_palette=True, image_noise_percent=options.noise)),
+    ]
+    for name, kwargs in cases:
+        begin = time.time()
+        verification = Verification(**kwargs)
+        startup = time.time() - begin
+        print "%-28s %8.1f images/sec   (startup %.3fs)" % (name, bench(verification, options.seconds), startup)
+
+
+if __name__ == '__main__':
+    main()
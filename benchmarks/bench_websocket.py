@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+benchmarks.bench_websocket
+messages/sec fanned out by UI.SocketPage.TopicRegistry to many local clients
+against serializing and writing each message per client with write_message
+runs create_app() against the configured database
+the clients share the IOLoop and bound the delivered rate, ms/publish is
+the time the publisher holds the IOLoop per message
+"""
+
+__author__ = 'Rnd495'
+
+import json
+import time
+import resource
+
+import tornado.gen
+import tornado.ioloop
+import tornado.httpclient
+import tornado.websocket
+from tornado.options import options, define
+
+from benchmarks import login, start_app_server
+
+
+def naive_publish(registry, topic, data):
+    """
+    the per subscriber way, kept here for comparison
+    """
+    for subscriber in list(registry.topics.get(topic, ())):
+        subscriber.write_message(json.dumps(dict(topic=topic, data=data)))
+
+
+@tornado.gen.coroutine
+def run_case(connections, publish, topic, count):
+    received = [0]
+    expected = len(connections) * count
+
+    @tornado.gen.coroutine
+    def read(connection):
+        for _ in range(count):
+            message = yield connection.read_message()
+            if message is None:
+                break
+            received[0] += 1
+    begin = time.time()
+    readers = [read(connection) for connection in connections]
+    payload = dict(type='battle', turn=0, log=['hit'] * 20)
+    publishing = 0.0
+    for i in range(count):
+        payload['turn'] = i
+        publish_begin = time.time()
+        publish(topic, payload)
+        publishing += time.time() - publish_begin
+        # let the loop drain writes as a real publisher would
+        yield tornado.gen.moment
+    yield readers
+    cost = time.time() - begin
+    assert received[0] == expected, (received[0], expected)
+    raise tornado.gen.Return((expected / cost, publishing * 1000 / count))
+
+
+@tornado.gen.coroutine
+def bench(base_url):
+    from UI.SocketPage import TopicRegistry
+    registry = TopicRegistry.instance()
+    cookie = yield login(base_url)
+    url = base_url.replace('http', 'ws') + '/socket'
+    connections = []
+    for _ in range(options.clients):
+        connection = yield tornado.websocket.websocket_connect(
+            tornado.httpclient.HTTPRequest(url, headers={'Cookie': cookie}))
+        connections.append(connection)
+    # every client is subscribed to the channel of the admin on open
+    topic = None
+    while topic is None:
+        topic = next((name for name, subscribers in registry.topics.iteritems()
+                      if len(subscribers) >= options.clients), None)
+        yield tornado.gen.sleep(0.05)
+    for name, publish in (('write_message', lambda topic, data: naive_publish(registry, topic, data)),
+                          ('shared frame', registry.publish)):
+        rate, publish_ms = yield run_case(connections, publish, topic, options.messages)
+        print "%-14s %6d clients  %10.0f messages/sec delivered  %8.2f ms/publish" % (
+            name, options.clients, rate, publish_ms)
+    for connection in connections:
+        connection.close()
+    print registry.stats()
+
+
+def main():
+    define("clients", default=1000, help="websocket clients", type=int)
+    define("messages", default=50, help="messages per case", type=int)
+    options.parse_command_line()
+
+    # two descriptors per client, the server side and the client side
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(max(soft, options.clients * 2 + 256), hard), hard))
+
+    from UI.Manager import create_app
+    app = create_app()
+    base_url = start_app_server(app)
+    tornado.ioloop.IOLoop.current().run_sync(lambda: bench(base_url), timeout=600)
+
+
+if __name__ == '__main__':
+    main()
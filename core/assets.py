@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+core.assets
+static asset pipeline
+
+the project's own js and css are minified, bundled and written under
+static/build/ with the content hash in their names, each with a .gz
+sibling, see Assets.build
+third-party libraries are vendored under static/vendor/ by
+"python -m core.assets --vendor", their cdn is used until then
+templates reach both through static_url, see StaticAssetHandler
+"""
+
+__author__ = 'Rnd495'
+__all__ = ['Assets', 'StaticAssetHandler', 'minify_css', 'minify_js']
+
+import os
+import re
+import gzip
+import urllib2
+import hashlib
+import mimetypes
+import StringIO
+
+import tornado.web
+
+from configs import Configs, ROOT_PATH
+
+configs = Configs.instance()
+
+STATIC_PATH = os.path.join(ROOT_PATH, "static")
+BUILD_DIR = 'build'
+VENDOR_DIR = 'vendor'
+SOURCE_DIRS = ('js', 'css')
+
+# bundle name -> sources, concatenated in order
+BUNDLES = {
+    'js/login.bundle.js': ('js/validation-login.js', 'js/verification-img-modal-popup.js'),
+    'js/register.bundle.js': ('js/validation-register.js', 'js/verification-img-modal-popup.js'),
+}
+
+# path under static/ -> where it is downloaded from, and served from until then
+_CDN = 'https://cdnjs.cloudflare.com/ajax/libs/'
+VENDOR = {
+    'vendor/jquery/2.1.1/jquery.min.js': _CDN + 'jquery/2.1.1/jquery.min.js',
+    'vendor/bootstrap/3.3.0/css/bootstrap.min.css': _CDN + 'twitter-bootstrap/3.3.0/css/bootstrap.min.css',
+    'vendor/bootstrap/3.3.0/js/bootstrap.min.js': _CDN + 'twitter-bootstrap/3.3.0/js/bootstrap.min.js',
+    'vendor/bootstrap/3.3.0/fonts/glyphicons-halflings-regular.eot':
+        _CDN + 'twitter-bootstrap/3.3.0/fonts/glyphicons-halflings-regular.eot',
+    'vendor/bootstrap/3.3.0/fonts/glyphicons-halflings-regular.svg':
+        _CDN + 'twitter-bootstrap/3.3.0/fonts/glyphicons-halflings-regular.svg',
+    'vendor/bootstrap/3.3.0/fonts/glyphicons-halflings-regular.ttf':
+        _CDN + 'twitter-bootstrap/3.3.0/fonts/glyphicons-halflings-regular.ttf',
+    'vendor/bootstrap/3.3.0/fonts/glyphicons-halflings-regular.woff':
+        _CDN + 'twitter-bootstrap/3.3.0/fonts/glyphicons-halflings-regular.woff',
+    'vendor/html5shiv/3.7.0/html5shiv.js': _CDN + 'html5shiv/3.7.0/html5shiv.js',
+    'vendor/respond.js/1.4.2/respond.min.js': _CDN + 'respond.js/1.4.2/respond.min.js',
+}
+
+COMPRESSIBLE_EXTENSIONS = ('.js', '.css', '.svg', '.eot', '.ttf')
+
+
+def minify_css(text):
+    """
+    drop comments except /*! ones and the whitespace around punctuation
+    """
+    text = re.sub(r'/\*(?!!).*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,])\s*', r'\1', text)
+    text = re.sub(r':\s+', ':', text)
+    return text.replace(';}', '}').strip()
+
+
+def minify_js(text):
+    """
+    conservative, line breaks are kept for automatic semicolon insertion
+    drops indentation, blank lines and whole line // comments
+    """
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line and not line.startswith('//'):
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+MINIFIERS = {'.js': minify_js, '.css': minify_css}
+
+
+def gzip_bytes(data, level):
+    """
+    gzip with a zero mtime, the same input always gives the same bytes
+    """
+    buf = StringIO.StringIO()
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=level, fileobj=buf, mtime=0) as gz:
+        gz.write(data)
+    return buf.getvalue()
+
+
+def _write_atomic(path, data):
+    """
+    workers may build at the same time, readers never see half a file
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.rename(temp_path, path)
+
+
+def _write_with_gzip(path, data, level):
+    if not os.path.exists(path):
+        _write_atomic(path, data)
+    if os.path.splitext(path)[1] in COMPRESSIBLE_EXTENSIONS and not os.path.exists(path + '.gz'):
+        _write_atomic(path + '.gz', gzip_bytes(data, level))
+
+
+class Assets(object):
+    """
+    Assets
+    manifest of the built assets, logical path -> path of the built file
+    both relative to static_path with "/" separators
+    """
+    def __init__(self, static_path=STATIC_PATH):
+        object.__init__(self)
+        self.static_path = static_path
+        self.manifest = {}
+
+    def _read(self, path):
+        with open(os.path.join(self.static_path, path), 'rb') as f:
+            return f.read()
+
+    def sources(self):
+        """
+        :return: logical path -> list of source paths
+        """
+        sources = {}
+        for directory in SOURCE_DIRS:
+            for file_name in sorted(os.listdir(os.path.join(self.static_path, directory))):
+                if os.path.splitext(file_name)[1] in MINIFIERS:
+                    path = '%s/%s' % (directory, file_name)
+                    sources[path] = [path]
+        for name, paths in BUNDLES.iteritems():
+            sources[name] = list(paths)
+        return sources
+
+    def build(self):
+        """
+        minify, fingerprint and pre-compress every source and bundle
+        files already built with the same content are left alone
+        :return: manifest
+        """
+        manifest = {}
+        for name, paths in sorted(self.sources().iteritems()):
+            base, extension = os.path.splitext(name)
+            minify = MINIFIERS[extension]
+            data = '\n'.join(minify(self._read(path)) for path in paths)
+            built = '%s/%s.%s%s' % (BUILD_DIR, base, hashlib.sha1(data).hexdigest()[:12], extension)
+            _write_with_gzip(os.path.join(self.static_path, built), data, configs.static_gzip_level)
+            manifest[name] = built
+        self.manifest = manifest
+        return manifest
+
+    def vendor(self, timeout=60):
+        """
+        download the missing vendored libraries, with .gz siblings
+        :return: list of downloaded paths
+        """
+        downloaded = []
+        for path, url in sorted(VENDOR.iteritems()):
+            target = os.path.join(self.static_path, path)
+            if os.path.exists(target):
+                continue
+            data = urllib2.urlopen(url, timeout=timeout).read()
+            _write_with_gzip(target, data, configs.static_gzip_level)
+            downloaded.append(path)
+        return downloaded
+
+    def is_vendored(self, path):
+        return os.path.exists(os.path.join(self.static_path, path))
+
+    def get_url(self, settings, path):
+        """
+        url of a built asset or of a library not vendored yet
+        :return: str or None when the path is served as is
+        """
+        built = self.manifest.get(path, None)
+        if built is not None:
+            return settings.get('static_url_prefix', '/static/') + built
+        if path in VENDOR and not self.is_vendored(path):
+            return VENDOR[path]
+        return None
+
+    @classmethod
+    def instance(cls):
+        if not hasattr(cls, '__instance__'):
+            cls.__instance__ = cls()
+        return cls.__instance__
+
+
+class StaticAssetHandler(tornado.web.StaticFileHandler):
+    """
+    StaticAssetHandler
+    serves the .gz sibling of a file to clients accepting gzip
+    built and vendored files never change under their path, so they are cached as immutable
+    """
+    IMMUTABLE_PREFIXES = (BUILD_DIR + '/', VENDOR_DIR + '/')
+
+    @classmethod
+    def make_static_url(cls, settings, path, include_version=True):
+        url = Assets.instance().get_url(settings, path)
+        if url is not None:
+            return url
+        return tornado.web.StaticFileHandler.make_static_url(settings, path, include_version)
+
+    def is_immutable(self, path):
+        return path.replace(os.path.sep, '/').startswith(self.IMMUTABLE_PREFIXES)
+
+    def validate_absolute_path(self, root, absolute_path):
+        absolute_path = tornado.web.StaticFileHandler.validate_absolute_path(self, root, absolute_path)
+        self.has_gzip = absolute_path is not None and os.path.isfile(absolute_path + '.gz')
+        if self.has_gzip and 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.set_header('Content-Encoding', 'gzip')
+            return absolute_path + '.gz'
+        return absolute_path
+
+    def get_content_type(self):
+        # the type of the file itself, not of its .gz sibling
+        path = self.absolute_path
+        if path.endswith('.gz') and self._headers.get('Content-Encoding') == 'gzip':
+            path = path[:-3]
+        mime_type, _ = mimetypes.guess_type(path)
+        return mime_type or 'application/octet-stream'
+
+    def get_cache_time(self, path, modified, mime_type):
+        if self.is_immutable(path):
+            return configs.static_immutable_max_age
+        return tornado.web.StaticFileHandler.get_cache_time(self, path, modified, mime_type)
+
+    def set_extra_headers(self, path):
+        if self.is_immutable(path):
+            self.set_header('Cache-Control', 'public, max-age=%d, immutable' % configs.static_immutable_max_age)
+        # the gzip transform adds it when enabled
+        if self.has_gzip and not self.settings.get('gzip', False):
+            self.set_header('Vary', 'Accept-Encoding')
+
+
+if __name__ == '__main__':
+    import sys
+    assets = Assets.instance()
+    if '--vendor' in sys.argv[1:]:
+        for vendored in assets.vendor():
+            print "vendored", vendored
+    for logical, built_path in sorted(assets.build().iteritems()):
+        print "%-32s -> %s" % (logical, built_path)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+core.battle
+turn based battles between two monsters
+
+every turn the faster monster attacks first with a random skill of its own,
+then the other one attacks if it is still alive, until one faints or
+max_turns is reached (a draw)
+damage = ((2 * level / 5 + 2) * power * atk / def / 50 + 2)
+         * 1.5 if the skill element is the monster element
+         * element effect of the skill element on the defender
+         * uniform random in [0.85, 1.0]
+a skill hits when a uniform random in [0, 100) is below its accuracy
+
+simulate runs one battle in python, simulate_batch runs many independent
+battles at once over numpy arrays of monster stats
+simulate_batch_parallel and simulate_batch_async split a batch across
+core.executors.get_process_pool()
+results are deterministic for a seed, but the scalar and batch paths
+draw their random numbers differently
+"""
+
+__author__ = 'Rnd495'
+__all__ = ['Move', 'Fighter', 'FighterArrays', 'BattleResult',
+           'load_fighters', 'simulate', 'simulate_batch',
+           'simulate_batch_parallel', 'simulate_batch_async']
+
+import random
+import collections
+
+import tornado.gen
+
+try:
+    # optional, needed by the batch mode only
+    import numpy
+except ImportError:
+    numpy = None
+
+import executors
+from models import Monster, MonsterHasSkill, Skill
+
+# skill_type_id of t_skill_type dealing damage with atk/def and sp_atk/sp_def
+PHYSICAL_SKILL_TYPE_ID = 1
+SPECIAL_SKILL_TYPE_ID = 2
+MAX_TURNS = 100
+STAB = 1.5
+
+Move = collections.namedtuple('Move', ['power', 'accuracy', 'element_id', 'special'])
+# used by monsters without any damaging skill
+DEFAULT_MOVE = Move(power=40, accuracy=100, element_id=0, special=False)
+
+BattleResult = collections.namedtuple('BattleResult', ['winner', 'turns', 'hp_a', 'hp_b'])
+
+
+class Fighter(object):
+    """
+    Fighter
+    battle stats of a monster and its damaging skills
+    """
+    __slots__ = ('monster_id', 'hp', 'atk', 'def_', 'spd', 'sp_atk', 'sp_def',
+                 'element_id', 'level', 'moves')
+
+    def __init__(self, hp, atk, def_, spd, sp_atk, sp_def, element_id, level, moves=(), monster_id=None):
+        self.monster_id = monster_id
+        self.hp = hp
+        self.atk = atk
+        self.def_ = def_
+        self.spd = spd
+        self.sp_atk = sp_atk
+        self.sp_def = sp_def
+        self.element_id = element_id or 0
+        self.level = level
+        self.moves = tuple(moves) or (DEFAULT_MOVE, )
+
+    @classmethod
+    def from_monster(cls, monster, skills=()):
+        moves = [Move(skill.skill_power, skill.skill_accuracy, skill.skill_element_id or 0,
+                      skill.skill_type_id == SPECIAL_SKILL_TYPE_ID)
+                 for skill in skills
+                 if skill.skill_type_id in (PHYSICAL_SKILL_TYPE_ID, SPECIAL_SKILL_TYPE_ID) and skill.skill_power]
+        return cls(monster.monster_hp, monster.monster_atk, monster.monster_def, monster.monster_spd,
+                   monster.monster_sp_atk, monster.monster_sp_def, monster.monster_element_id,
+                   monster.monster_level, moves, monster.monster_id)
+
+
+def load_fighters(session, monster_ids):
+    """
+    Fighters of monsters and their skills, in two queries
+    :param monster_ids: iterable of monster_id
+    :return: dict of monster_id to Fighter
+    """
+    monster_ids = list(monster_ids)
+    if not monster_ids:
+        return {}
+    skills = collections.defaultdict(list)
+    rows = session.query(MonsterHasSkill.monster_id, Skill).join(
+        Skill, Skill.skill_id == MonsterHasSkill.skill_id).filter(MonsterHasSkill.monster_id.in_(monster_ids))
+    for monster_id, skill in rows:
+        skills[monster_id].append(skill)
+    monsters = session.query(Monster).filter(Monster.monster_id.in_(monster_ids))
+    return dict((monster.monster_id, Fighter.from_monster(monster, skills[monster.monster_id]))
+                for monster in monsters)
+
+
+def _damage(attacker, defender, move, matrix, rnd):
+    if rnd.random() * 100 >= move.accuracy:
+        return 0
+    if move.special:
+        atk, dfn = attacker.sp_atk, defender.sp_def
+    else:
+        atk, dfn = attacker.atk, defender.def_
+    damage = ((2.0 * attacker.level / 5 + 2) * move.power * atk / max(dfn, 1) / 50 + 2)
+    if move.element_id and move.element_id == attacker.element_id:
+        damage *= STAB
+    damage *= matrix.multiplier(move.element_id, defender.element_id)
+    return int(damage * rnd.uniform(0.85, 1.0))
+
+
+def simulate(fighter_a, fighter_b, matrix, seed=None, max_turns=MAX_TURNS):
+    """
+    one battle
+    :param matrix: core.elements.ElementMatrix
+    :param seed: seed of random.Random, None for a random battle
+    :return: BattleResult, winner is 0 for a, 1 for b and -1 for a draw
+    """
+    rnd = random.Random(seed)
+    hp = [fighter_a.hp, fighter_b.hp]
+    fighters = (fighter_a, fighter_b)
+    for turn in xrange(1, max_turns + 1):
+        if fighter_a.spd != fighter_b.spd:
+            first = 0 if fighter_a.spd > fighter_b.spd else 1
+        else:
+            first = rnd.randint(0, 1)
+        for side in (first, 1 - first):
+            attacker, defender = fighters[side], fighters[1 - side]
+            hp[1 - side] -= _damage(attacker, defender, rnd.choice(attacker.moves), matrix, rnd)
+            if hp[1 - side] <= 0:
+                return BattleResult(side, turn, hp[0], hp[1])
+    return BattleResult(-1, max_turns, hp[0], hp[1])
+
+
+class FighterArrays(object):
+    """
+    FighterArrays
+    stats of n fighters as numpy arrays, one element per battle
+    moves are padded to the largest move count, move_count tells the real one
+    """
+    FIELDS = ('hp', 'atk', 'def_', 'spd', 'sp_atk', 'sp_def', 'element_id', 'level',
+              'move_count', 'move_power', 'move_accuracy', 'move_element_id', 'move_special')
+
+    def __init__(self, **arrays):
+        object.__init__(self)
+        for field in self.FIELDS:
+            setattr(self, field, arrays[field])
+
+    def __len__(self):
+        return len(self.hp)
+
+    @classmethod
+    def from_fighters(cls, fighters):
+        if numpy is None:
+            raise RuntimeError('RuntimeError: numpy is needed by the batch battle mode')
+        fighters = list(fighters)
+        width = max([len(fighter.moves) for fighter in fighters] or [1])
+        moves = [fighter.moves + (fighter.moves[-1], ) * (width - len(fighter.moves)) for fighter in fighters]
+
+        def stat(name, dtype=numpy.float64):
+            return numpy.array([getattr(fighter, name) for fighter in fighters], dtype=dtype)
+
+        def move_stat(index, dtype):
+            return numpy.array([[move[index] for move in row] for row in moves], dtype=dtype).reshape(-1, width)
+        return cls(hp=stat('hp'), atk=stat('atk'), def_=stat('def_'), spd=stat('spd'),
+                   sp_atk=stat('sp_atk'), sp_def=stat('sp_def'),
+                   element_id=stat('element_id', numpy.intp), level=stat('level'),
+                   move_count=numpy.array([len(fighter.moves) for fighter in fighters], dtype=numpy.intp),
+                   move_power=move_stat(0, numpy.float64), move_accuracy=move_stat(1, numpy.float64),
+                   move_element_id=move_stat(2, numpy.intp), move_special=move_stat(3, numpy.bool_))
+
+    def slice(self, begin, end):
+        return FighterArrays(**dict((field, getattr(self, field)[begin:end]) for field in self.FIELDS))
+
+    def take(self, indices):
+        return FighterArrays(**dict((field, getattr(self, field)[indices]) for field in self.FIELDS))
+
+
+def _batch_damage(attacker, defender, matrix, rnd):
+    n = len(attacker)
+    rows = numpy.arange(n)
+    choice = (rnd.random_sample(n) * attacker.move_count).astype(numpy.intp)
+    power = attacker.move_power[rows, choice]
+    accuracy = attacker.move_accuracy[rows, choice]
+    element_id = attacker.move_element_id[rows, choice]
+    special = attacker.move_special[rows, choice]
+    atk = numpy.where(special, attacker.sp_atk, attacker.atk)
+    dfn = numpy.maximum(numpy.where(special, defender.sp_def, defender.def_), 1)
+    damage = (2.0 * attacker.level / 5 + 2) * power * atk / dfn / 50 + 2
+    damage *= numpy.where((element_id != 0) & (element_id == attacker.element_id), STAB, 1.0)
+    damage *= matrix.multipliers(element_id, defender.element_id)
+    damage *= rnd.uniform(0.85, 1.0, n)
+    damage = numpy.floor(damage)
+    damage[rnd.random_sample(n) * 100 >= accuracy] = 0
+    return damage
+
+
+def simulate_batch(side_a, side_b, matrix, seed=None, max_turns=MAX_TURNS):
+    """
+    len(side_a) independent battles, side_a[i] against side_b[i]
+    :param side_a: FighterArrays
+    :param side_b: FighterArrays, same length
+    :param matrix: core.elements.ElementMatrix
+    :param seed: seed of numpy.random.RandomState
+    :return: (winner, turns, hp_a, hp_b) numpy arrays, see BattleResult
+    """
+    rnd = numpy.random.RandomState(seed)
+    winner = numpy.full(len(side_a), -1, dtype=numpy.int8)
+    turns = numpy.full(len(side_a), max_turns, dtype=numpy.int32)
+    result_hp_a = side_a.hp.copy()
+    result_hp_b = side_b.hp.copy()
+    # battles still running, their stats are compacted once half of them are finished
+    index = numpy.arange(len(side_a))
+    hp_a = result_hp_a.copy()
+    hp_b = result_hp_b.copy()
+    active = numpy.ones(len(side_a), dtype=numpy.bool_)
+    for turn in xrange(1, max_turns + 1):
+        n = len(index)
+        a_first = (side_a.spd > side_b.spd) | ((side_a.spd == side_b.spd) & (rnd.random_sample(n) < 0.5))
+        damage_to_b = _batch_damage(side_a, side_b, matrix, rnd)
+        damage_to_a = _batch_damage(side_b, side_a, matrix, rnd)
+        # first attacks
+        hp_b -= numpy.where(active & a_first, damage_to_b, 0)
+        hp_a -= numpy.where(active & ~a_first, damage_to_a, 0)
+        # second attacks, only by monsters still standing
+        hp_a -= numpy.where(active & a_first & (hp_b > 0), damage_to_a, 0)
+        hp_b -= numpy.where(active & ~a_first & (hp_a > 0), damage_to_b, 0)
+        a_won = active & (hp_b <= 0)
+        b_won = active & (hp_a <= 0)
+        winner[index[a_won]] = 0
+        winner[index[b_won]] = 1
+        finished = a_won | b_won
+        turns[index[finished]] = turn
+        active &= ~finished
+        remaining = numpy.count_nonzero(active)
+        if remaining * 2 <= n:
+            result_hp_a[index] = hp_a
+            result_hp_b[index] = hp_b
+            if not remaining:
+                break
+            keep = numpy.flatnonzero(active)
+            index = index[keep]
+            side_a = side_a.take(keep)
+            side_b = side_b.take(keep)
+            hp_a = hp_a[keep]
+            hp_b = hp_b[keep]
+            active = numpy.ones(remaining, dtype=numpy.bool_)
+    else:
+        result_hp_a[index] = hp_a
+        result_hp_b[index] = hp_b
+    return winner, turns, result_hp_a, result_hp_b
+
+
+def _chunks(side_a, side_b, chunk_size):
+    for index, begin in enumerate(xrange(0, len(side_a), chunk_size)):
+        end = begin + chunk_size
+        yield index, side_a.slice(begin, end), side_b.slice(begin, end)
+
+
+def _submit_chunks(side_a, side_b, matrix, seed, max_turns, chunk_size, executor):
+    executor = executor or executors.get_process_pool()
+    return [executor.submit(simulate_batch, chunk_a, chunk_b, matrix,
+                            None if seed is None else seed + index, max_turns)
+            for index, chunk_a, chunk_b in _chunks(side_a, side_b, chunk_size)]
+
+
+def _concatenate(results):
+    return tuple(numpy.concatenate(arrays) for arrays in zip(*results))
+
+
+def simulate_batch_parallel(side_a, side_b, matrix, seed=None, max_turns=MAX_TURNS,
+                            chunk_size=4096, executor=None):
+    """
+    simulate_batch split into chunks of chunk_size battles across a process pool
+    chunk i is seeded with seed + i, so results depend on chunk_size but not on the pool size
+    :param executor: concurrent.futures executor, default core.executors.get_process_pool()
+    """
+    futures = _submit_chunks(side_a, side_b, matrix, seed, max_turns, chunk_size, executor)
+    return _concatenate([future.result() for future in futures])
+
+
+@tornado.gen.coroutine
+def simulate_batch_async(side_a, side_b, matrix, seed=None, max_turns=MAX_TURNS,
+                         chunk_size=4096, executor=None):
+    """
+    simulate_batch_parallel for coroutines, the IOLoop keeps running meanwhile
+    """
+    results = yield _submit_chunks(side_a, side_b, matrix, seed, max_turns, chunk_size, executor)
+    raise tornado.gen.Return(_concatenate(results))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+core.cache
+"""
+
+__author__ = 'Rnd495'
+__all__ = ['LRUCache', 'RateLimiter']
+
+import time
+import collections
+
+
+class LRUCache(object):
+    """
+    LRUCache
+    least recently used cache of at most capacity items
+    items older than ttl seconds are treated as missing, ttl None keeps them forever
+    """
+    def __init__(self, capacity, ttl=None):
+        object.__init__(self)
+        self.capacity = capacity
+        self.ttl = ttl
+        # key -> (expire_timestamp, value), least recently used first
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return self.get(key, None) is not None
+
+    def get(self, key, default=None):
+        item = self.items.pop(key, None)
+        if item is None or (item[0] is not None and item[0] < time.time()):
+            self.misses += 1
+            return default
+        # move to the most recently used end
+        self.items[key] = item
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value):
+        if self.capacity <= 0:
+            return
+        self.items.pop(key, None)
+        self.items[key] = (time.time() + self.ttl if self.ttl else None, value)
+        while len(self.items) > self.capacity:
+            self.items.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        item = self.items.pop(key, None)
+        return item[1] if item is not None else default
+
+    def clear(self):
+        self.items.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(
+            size=len(self.items),
+            capacity=self.capacity,
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=float(self.hits) / lookups if lookups else 0.0,
+            evictions=self.evictions)
+
+
+class RateLimiter(object):
+    """
+    RateLimiter
+    token bucket per key, refilled with rate tokens per second up to burst
+    buckets live in an LRUCache so memory stays bounded
+    """
+    def __init__(self, rate, burst, capacity=10000):
+        object.__init__(self)
+        self.rate = rate
+        self.burst = burst
+        self.buckets = LRUCache(capacity)
+        self.rejected = 0
+
+    def allow(self, key):
+        now = time.time()
+        tokens, last = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets.set(key, (tokens, now))
+            self.rejected += 1
+            return False
+        self.buckets.set(key, (tokens - 1, now))
+        return True
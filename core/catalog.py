@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+core.catalog
+in memory copy of the static game reference tables
+"""
+
+__author__ = 'Rnd495'
+__all__ = ['Catalog']
+
+import json
+import hashlib
+import datetime
+import collections
+
+import models
+
+# catalog name, model
+TABLES = (
+    ('roles', models.Role),
+    ('elements', models.Element),
+    ('element_effects', models.ElementVSElement),
+    ('monster_types', models.MonsterType),
+    ('skills', models.Skill),
+    ('skill_types', models.SkillType),
+    ('skill_target_types', models.SkillTargetType),
+    ('sp_skills', models.SPSkill),
+)
+
+
+def _record_type(model):
+    """
+    namedtuple of the columns of a model, immutable and without __dict__
+    """
+    return collections.namedtuple(model.__name__ + 'Record', [column.key for column in model.__table__.columns])
+
+
+def _json_default(val):
+    if isinstance(val, datetime.datetime):
+        return val.strftime(models.Base.DATETIME_FORMAT)
+    raise TypeError(repr(val))
+
+
+class CatalogSnapshot(object):
+    """
+    CatalogSnapshot
+    records, id indexes and the serialized form of one load of the catalog
+    never changed once built, Catalog.load swaps in a new one
+    """
+    __slots__ = ('records', 'indexes', 'version', 'body')
+
+    def __init__(self, records, indexes):
+        self.records = records
+        self.indexes = indexes
+        # serialized once per load, served as is by /api/catalog
+        self.body = json.dumps(
+            dict((name, [record._asdict() for record in rows]) for name, rows in records.iteritems()),
+            sort_keys=True, default=_json_default)
+        self.version = hashlib.sha1(self.body).hexdigest()[:16]
+
+
+class Catalog(object):
+    """
+    Catalog
+    reference tables loaded once into namedtuple records indexed by primary key
+    composite keys, like the one of element_effects, are indexed by tuple
+    """
+    def __init__(self):
+        object.__init__(self)
+        self.record_types = dict((name, _record_type(model)) for name, model in TABLES)
+        self.snapshot = CatalogSnapshot(dict((name, ()) for name, _ in TABLES),
+                                        dict((name, {}) for name, _ in TABLES))
+        self.loaded = False
+
+    def load(self, session):
+        records = {}
+        indexes = {}
+        for name, model in TABLES:
+            record_type = self.record_types[name]
+            table = model.__table__
+            keys = [column.key for column in table.primary_key.columns]
+            rows = tuple(record_type(*row) for row in session.query(table).order_by(*table.primary_key.columns))
+            records[name] = rows
+            if len(keys) == 1:
+                indexes[name] = dict((getattr(row, keys[0]), row) for row in rows)
+            else:
+                indexes[name] = dict((tuple(getattr(row, key) for key in keys), row) for row in rows)
+        self.snapshot = CatalogSnapshot(records, indexes)
+        self.loaded = True
+
+    reload = load
+
+    @property
+    def version(self):
+        return self.snapshot.version
+
+    @property
+    def body(self):
+        """
+        json of the whole catalog
+        """
+        return self.snapshot.body
+
+    def all(self, name):
+        """
+        :return: tuple of records ordered by primary key
+        """
+        return self.snapshot.records[name]
+
+    def get(self, name, key, default=None):
+        """
+        :param name: catalog name, e.g. "skills"
+        :param key: primary key, a tuple for composite keys
+        """
+        return self.snapshot.indexes[name].get(key, default)
+
+    @classmethod
+    def instance(cls):
+        if not hasattr(cls, '__instance__'):
+            cls.__instance__ = cls()
+        return cls.__instance__
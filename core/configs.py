@@ -41,7 +41,16 @@ class Configs(object):
     """
     Configs
     """
-    def __init__(self, config_file_name):
+    def __init__(self, config_file_name, default_file_name=None):
+        # values missing in config_file_name fall back to default_file_name
+        if default_file_name and default_file_name != config_file_name:
+            self.load(default_file_name)
+        self.load(config_file_name)
+        for name in CONFIG_NOTNULL:
+            if not self.__dict__.get(name, None):
+                raise ConfigsError('ConfigsError: property "%s" is not set' % name)
+
+    def load(self, config_file_name):
         with open(config_file_name, 'rb') as file_handle:
             for line in file_handle:
                 line = line.strip()
@@ -64,14 +73,11 @@ class Configs(object):
                         self.__dict__[name] = False
                 else:
                     self.__dict__[name] = int(value)
-        for name in CONFIG_NOTNULL:
-            if not self.__dict__.get(name, None):
-                raise ConfigsError('ConfigsError: property "%s" is not set' % name)
 
     @staticmethod
     def instance():
         if not hasattr(Configs, "_instance"):
-            Configs._instance = Configs(CONFIG_PATH_NOW)
+            Configs._instance = Configs(CONFIG_PATH_NOW, CONFIG_PATH_DEFAULT)
         return Configs._instance
 
 if __name__ == '__main__':
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+core.elements
+"""
+
+__author__ = 'Rnd495'
+__all__ = ['ElementMatrix']
+
+from array import array
+
+import tornado.ioloop
+from sqlalchemy import func
+from tornado.log import app_log
+
+try:
+    # optional, used for the batch lookups
+    import numpy
+except ImportError:
+    numpy = None
+
+import models
+import executors
+from models import ElementVSElement
+
+
+class ElementMatrix(object):
+    """
+    ElementMatrix
+    effect of t_element_vs_element in a flat array('f') indexed by
+    atk_element_id * size + def_element_id
+    element id 0 stands for "no element", pairs missing from the table
+    and pairs with element 0 have effect 1.0
+    """
+    def __init__(self):
+        object.__init__(self)
+        # (size, effects, numpy matrix or None), replaced as a whole by load
+        self.table = (1, array('f', [1.0]), None)
+        self.signature = None
+        self.load_count = 0
+
+    @staticmethod
+    def get_signature(session):
+        """
+        row count and weighted sums of t_element_vs_element, changes whenever an effect does
+        """
+        position = ElementVSElement.atk_element_id * 1000 + ElementVSElement.def_element_id
+        return tuple(session.query(
+            func.count(),
+            func.sum(ElementVSElement.effect),
+            func.sum(ElementVSElement.effect * position)).one())
+
+    def load(self, session):
+        rows = session.query(
+            ElementVSElement.atk_element_id,
+            ElementVSElement.def_element_id,
+            ElementVSElement.effect).all()
+        size = max([max(atk, dfn) for atk, dfn, _ in rows] or [0]) + 1
+        effects = array('f', [1.0]) * (size * size)
+        for atk, dfn, effect in rows:
+            effects[atk * size + dfn] = effect
+        matrix = numpy.frombuffer(effects, dtype=numpy.float32).reshape(size, size) if numpy else None
+        self.table = (size, effects, matrix)
+        self.signature = self.get_signature(session)
+        self.load_count += 1
+
+    def refresh_if_changed(self, session):
+        """
+        reload when the signature of the table differs from the loaded one
+        :return: True if reloaded
+        """
+        if self.signature is not None and self.get_signature(session) == self.signature:
+            return False
+        self.load(session)
+        return True
+
+    def start_refresher(self, interval):
+        """
+        check the table for changes every interval seconds, in the database pool
+        :param interval: seconds
+        :return: tornado.ioloop.PeriodicCallback
+        """
+        io_loop = tornado.ioloop.IOLoop.current()
+
+        def on_done(future):
+            exception = future.exception()
+            if exception is not None:
+                app_log.error("element matrix refresh failed: %r", exception)
+
+        def refresh():
+            io_loop.add_future(
+                executors.get_database_pool().submit(models.run_in_session, self.refresh_if_changed), on_done)
+        refresher = tornado.ioloop.PeriodicCallback(refresh, interval * 1000)
+        refresher.start()
+        return refresher
+
+    def multiplier(self, atk_element_id, def_element_id):
+        """
+        :param atk_element_id: element of the attack
+        :param def_element_id: element of the defender, 0 or None for none
+        :return: float
+        """
+        size, effects, _ = self.table
+        atk_element_id = atk_element_id or 0
+        def_element_id = def_element_id or 0
+        if not (0 <= atk_element_id < size and 0 <= def_element_id < size):
+            return 1.0
+        return effects[atk_element_id * size + def_element_id]
+
+    def dual_multiplier(self, atk_element_id, def_element_ids):
+        """
+        product of the effects against every element of a defender
+        :param def_element_ids: iterable of element ids
+        :return: float
+        """
+        result = 1.0
+        for def_element_id in def_element_ids:
+            result *= self.multiplier(atk_element_id, def_element_id)
+        return result
+
+    def multipliers(self, atk_element_ids, def_element_ids, def_element_ids_2=None):
+        """
+        effects of a batch of attacks
+        :param atk_element_ids: sequence of element ids
+        :param def_element_ids: sequence of element ids, same length
+        :param def_element_ids_2: second elements of dual element defenders, 0 for none
+        :return: numpy.ndarray of float32 when numpy is available, else list
+        unknown element ids have effect 1.0, as in multiplier
+        """
+        size, effects, matrix = self.table
+        if matrix is not None:
+            atk = numpy.asarray(atk_element_ids, dtype=numpy.intp)
+            result = self._lookup(matrix, size, atk, numpy.asarray(def_element_ids, dtype=numpy.intp))
+            if def_element_ids_2 is not None:
+                result *= self._lookup(matrix, size, atk, numpy.asarray(def_element_ids_2, dtype=numpy.intp))
+            return result
+        if def_element_ids_2 is None:
+            return [self.multiplier(atk, dfn) for atk, dfn in zip(atk_element_ids, def_element_ids)]
+        return [self.multiplier(atk, dfn) * self.multiplier(atk, dfn_2)
+                for atk, dfn, dfn_2 in zip(atk_element_ids, def_element_ids, def_element_ids_2)]
+
+    @staticmethod
+    def _lookup(matrix, size, atk, dfn):
+        # negative ids would wrap around, ids past the matrix raise
+        valid = (atk >= 0) & (atk < size) & (dfn >= 0) & (dfn < size)
+        result = numpy.ones(atk.shape, dtype=numpy.float32)
+        result[valid] = matrix[atk[valid], dfn[valid]]
+        return result
+
+    def stats(self):
+        return dict(size=self.table[0], loads=self.load_count, numpy=self.table[2] is not None)
+
+    @classmethod
+    def instance(cls):
+        if not hasattr(cls, '__instance__'):
+            cls.__instance__ = cls()
+        return cls.__instance__
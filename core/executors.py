@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+core.executors
+"""
+
+__author__ = 'Rnd495'
+
+import threading
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from configs import Configs
+
+configs = Configs.instance()
+
+_process_pool = None
+_database_pool = None
+_password_pool = None
+# the IOLoop and the verification pool refill thread may both create a pool first
+_lock = threading.Lock()
+# worker processes of main.py sharing the cpus of the host
+_worker_count = 1
+
+
+def set_worker_count(count):
+    """
+    share the process pool sizes out among count worker processes
+    call it before the first pool is created
+    """
+    global _worker_count
+    _worker_count = max(count, 1)
+
+
+def _share(size):
+    """
+    :param size: processes for the whole host, 0 means one per cpu
+    :return: processes for this worker, at least 1
+    """
+    return max((size or multiprocessing.cpu_count()) // _worker_count, 1)
+
+
+def get_process_pool():
+    """
+    shared process pool for cpu bound work
+    created on first use, so forked workers never share a parent's pool
+    :return: ProcessPoolExecutor
+    """
+    global _process_pool
+    if _process_pool is None:
+        with _lock:
+            if _process_pool is None:
+                _process_pool = ProcessPoolExecutor(max_workers=_share(configs.process_pool_size))
+    return _process_pool
+
+
+def get_database_pool():
+    """
+    shared thread pool running blocking database queries off the IOLoop
+    :return: ThreadPoolExecutor
+    """
+    global _database_pool
+    if _database_pool is None:
+        with _lock:
+            if _database_pool is None:
+                _database_pool = ThreadPoolExecutor(max_workers=configs.database_executor_size)
+    return _database_pool
+
+
+def get_password_pool():
+    """
+    process pool of its own for password hashing
+    a burst of logins is held to password_hash_process_count cores
+    and never queues behind other cpu bound work
+    :return: ProcessPoolExecutor
+    """
+    global _password_pool
+    if _password_pool is None:
+        with _lock:
+            if _password_pool is None:
+                _password_pool = ProcessPoolExecutor(max_workers=_share(configs.password_hash_process_count))
+    return _password_pool
+
+
+def start_process_pools():
+    """
+    start the processes of the process pools now rather than on first use
+    they then never inherit sockets bound afterwards
+    """
+    for pool in (get_process_pool(), get_password_pool()):
+        pool.submit(int).result()
+
+
+def shutdown(wait=False):
+    """
+    :param wait: wait for the pools to finish, needed before os._exit
+                 or pool processes outlive this one
+    """
+    global _process_pool, _database_pool, _password_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=wait)
+        _process_pool = None
+    if _database_pool is not None:
+        _database_pool.shutdown(wait=wait)
+        _database_pool = None
+    if _password_pool is not None:
+        _password_pool.shutdown(wait=wait)
+        _password_pool = None
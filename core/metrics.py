@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+core.metrics
+request timings of this process, exported in the prometheus text format
+
+a request is timed by a RequestTiming, broken down into phases:
+    db          time in cursor execute, see instrument_engine
+    render      template rendering
+    captcha     verification code generation
+    serialize   json encoding and row to dict conversion
+    loop        time the handler held the IOLoop, see HandlerContext
+phases may overlap, e.g. a verification code made by a template counts
+in render and in captcha
+histograms are only written on the IOLoop thread, in PageBase.on_finish,
+so they need no lock; threads of the database pool only add to the
+RequestTiming bound to them, see bind
+the stats dicts of caches and pools are exported along, see Metrics.register_stats
+
+the IOLoop hooks are tied to tornado 4.5: SlowCallbackDetector patches the
+private IOLoop._run_callback and HandlerContext runs in a
+tornado.stack_context.StackContext, deprecated in 5.1 and gone in 6,
+on any other version they are off, see TORNADO_VERSIONS; requests are
+still timed then, without loop time and slow callbacks
+"""
+
+__author__ = 'Rnd495'
+__all__ = ['Histogram', 'RequestTiming', 'Metrics', 'HandlerContext', 'SlowCallbackDetector',
+           'bind', 'current_timing', 'instrument_engine', 'handler_context']
+
+import time
+import bisect
+import threading
+import contextlib
+
+import tornado
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from tornado.log import app_log
+
+# tornado releases the IOLoop hooks were checked against, [first, last]
+TORNADO_VERSIONS = ((4, 5), (4, 5))
+HOOKS_ENABLED = TORNADO_VERSIONS[0] <= tornado.version_info[:2] <= TORNADO_VERSIONS[1]
+if HOOKS_ENABLED:
+    import tornado.stack_context
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PHASES = ('db', 'render', 'captcha', 'serialize', 'loop')
+
+
+class Histogram(object):
+    """
+    Histogram
+    counts of observations per bucket, upper bounds in buckets
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # the last one counts what is above every bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        :return: list of (upper bound str, count of observations <= bound)
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'), ), self.counts):
+            total += count
+            result.append(('+Inf' if bound == float('inf') else repr(bound), total))
+        return result
+
+
+class RequestTiming(object):
+    """
+    RequestTiming
+    seconds spent per phase by one request
+    """
+    __slots__ = PHASES + ('queries', 'segment_begin')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def close_segment(self):
+        """
+        add the IOLoop callback running now to loop, e.g. when the request finishes in it
+        """
+        if self.segment_begin:
+            now = time.time()
+            self.loop += now - self.segment_begin
+            self.segment_begin = now
+
+    def add(self, phase, seconds):
+        setattr(self, phase, getattr(self, phase) + seconds)
+
+    @contextlib.contextmanager
+    def measure(self, phase):
+        begin = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - begin)
+
+
+# timing of the request a database pool thread is working for
+_local = threading.local()
+# stands in when no request is bound, whatever it collects is dropped
+_unbound_timing = RequestTiming()
+# thread ident -> name of the handler the thread is working for, see core.profiler
+bound_handlers = {}
+
+
+def bind(timing, function, handler=None):
+    """
+    function bound to timing and to the name of its handler, for the database pool
+    """
+    def bound(*args, **kwargs):
+        _local.timing = timing
+        ident = threading.current_thread().ident
+        bound_handlers[ident] = handler
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.timing = None
+            bound_handlers.pop(ident, None)
+    return bound
+
+
+def current_timing():
+    """
+    RequestTiming bound to this thread, a throwaway one if none is
+    """
+    return getattr(_local, 'timing', None) or _unbound_timing
+
+
+def _on_session_begin(session, transaction, connection):
+    # sessions of PageBase.db carry the timing of their request
+    timing = session.info.get('timing', None)
+    if timing is not None:
+        connection.info['timing'] = timing
+
+
+def _on_checkin(dbapi_connection, connection_record):
+    connection_record.info.pop('timing', None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_begin', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.time() - conn.info['query_begin'].pop()
+    timing = conn.info.get('timing', None) or current_timing()
+    timing.db += elapsed
+    timing.queries += 1
+
+
+def instrument_engine(engine):
+    """
+    add the cursor execute time of every query to the timing of its request
+    """
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'checkin', _on_checkin)
+
+
+event.listen(Session, 'after_begin', _on_session_begin)
+
+
+class Metrics(object):
+    """
+    Metrics
+    histograms and counters of this process
+    """
+    PREFIX = 'webgame_'
+
+    def __init__(self):
+        object.__init__(self)
+        self.started = time.time()
+        # handler -> Histogram
+        self.requests = {}
+        # (handler, phase) -> Histogram
+        self.phases = {}
+        # (handler, status code) -> count
+        self.responses = {}
+        # handler -> count
+        self.queries = {}
+        # handler -> [count, seconds]
+        self.slow_callbacks = {}
+        # name of the handler whose callback runs on the IOLoop, see HandlerContext
+        self.current_handler = None
+        # last handler entered by the running callback, see SlowCallbackDetector
+        self.last_handler = None
+        # [(name, function returning a stats dict, keys counting up)]
+        self.stats_sources = []
+
+    def register_stats(self, name, function, counters=()):
+        """
+        export the numbers of function() as <PREFIX><name>_<key>
+        :param counters: keys that only count up, exported as counters, the others as gauges
+        """
+        self.stats_sources = [source for source in self.stats_sources if source[0] != name]
+        self.stats_sources.append((name, function, frozenset(counters)))
+
+    def observe_request(self, handler, status_code, seconds, timing):
+        histogram = self.requests.get(handler, None)
+        if histogram is None:
+            histogram = self.requests[handler] = Histogram()
+        histogram.observe(seconds)
+        # a phase is counted only by requests that went through it
+        for phase in PHASES:
+            value = getattr(timing, phase)
+            if value:
+                key = (handler, phase)
+                histogram = self.phases.get(key, None)
+                if histogram is None:
+                    histogram = self.phases[key] = Histogram()
+                histogram.observe(value)
+        key = (handler, status_code)
+        self.responses[key] = self.responses.get(key, 0) + 1
+        if timing.queries:
+            self.queries[handler] = self.queries.get(handler, 0) + timing.queries
+
+    def observe_slow_callback(self, handler, seconds):
+        record = self.slow_callbacks.setdefault(handler, [0, 0.0])
+        record[0] += 1
+        record[1] += seconds
+
+    @staticmethod
+    def _labels(**labels):
+        return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for name, value in sorted(labels.iteritems()))
+
+    def _histogram_lines(self, lines, name, histograms, label_names):
+        for key, histogram in sorted(histograms.iteritems()):
+            labels = dict(zip(label_names, key if isinstance(key, tuple) else (key, )))
+            for bound, count in histogram.cumulative():
+                lines.append('%s_bucket%s %d' % (name, self._labels(le=bound, **labels), count))
+            lines.append('%s_sum%s %r' % (name, self._labels(**labels), histogram.sum))
+            lines.append('%s_count%s %d' % (name, self._labels(**labels), histogram.count))
+
+    def render(self):
+        """
+        :return: str in the prometheus text exposition format
+        """
+        prefix = self.PREFIX
+        lines = [
+            '# HELP %sprocess_start_time_seconds start time of this process' % prefix,
+            '# TYPE %sprocess_start_time_seconds gauge' % prefix,
+            '%sprocess_start_time_seconds %r' % (prefix, self.started),
+            '# HELP %srequest_seconds time to serve a request' % prefix,
+            '# TYPE %srequest_seconds histogram' % prefix,
+        ]
+        self._histogram_lines(lines, prefix + 'request_seconds', self.requests, ('handler', ))
+        lines.extend([
+            '# HELP %srequest_phase_seconds time a request spent per phase, among requests that went through it'
+            % prefix,
+            '# TYPE %srequest_phase_seconds histogram' % prefix,
+        ])
+        self._histogram_lines(lines, prefix + 'request_phase_seconds', self.phases, ('handler', 'phase'))
+        lines.extend([
+            '# HELP %sresponses_total responses by status code' % prefix,
+            '# TYPE %sresponses_total counter' % prefix,
+        ])
+        for (handler, code), count in sorted(self.responses.iteritems()):
+            lines.append('%sresponses_total%s %d' % (prefix, self._labels(handler=handler, code=code), count))
+        lines.extend([
+            '# HELP %sdb_queries_total database queries run for requests' % prefix,
+            '# TYPE %sdb_queries_total counter' % prefix,
+        ])
+        for handler, count in sorted(self.queries.iteritems()):
+            lines.append('%sdb_queries_total%s %d' % (prefix, self._labels(handler=handler), count))
+        lines.extend([
+            '# HELP %sslow_callbacks_total IOLoop callbacks slower than the threshold' % prefix,
+            '# TYPE %sslow_callbacks_total counter' % prefix,
+        ])
+        for handler, (count, _) in sorted(self.slow_callbacks.iteritems()):
+            lines.append('%sslow_callbacks_total%s %d' % (prefix, self._labels(handler=handler), count))
+        lines.extend([
+            '# HELP %sslow_callback_seconds_total time spent in IOLoop callbacks slower than the threshold' % prefix,
+            '# TYPE %sslow_callback_seconds_total counter' % prefix,
+        ])
+        for handler, (_, seconds) in sorted(self.slow_callbacks.iteritems()):
+            lines.append('%sslow_callback_seconds_total%s %r' % (prefix, self._labels(handler=handler), seconds))
+        for name, function, counters in self.stats_sources:
+            for key, value in sorted(function().iteritems()):
+                if isinstance(value, bool):
+                    value = int(value)
+                elif not isinstance(value, (int, long, float)):
+                    continue
+                metric = '%s%s_%s' % (prefix, name, key)
+                if key in counters:
+                    metric += '_total'
+                lines.extend([
+                    '# HELP %s %s of %s' % (metric, key, name),
+                    '# TYPE %s %s' % (metric, 'counter' if key in counters else 'gauge'),
+                    '%s %r' % (metric, value),
+                ])
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def instance(cls):
+        if not hasattr(cls, '__instance__'):
+            cls.__instance__ = cls()
+        return cls.__instance__
+
+
+class HandlerContext(object):
+    """
+    HandlerContext
+    entered around every IOLoop callback of a handler, used with
+    tornado.stack_context.StackContext
+    adds the time of each callback to timing.loop and names the handler
+    for SlowCallbackDetector
+    """
+    __slots__ = ('name', 'timing', 'outer')
+
+    def __init__(self, name, timing):
+        self.name = name
+        self.timing = timing
+        self.outer = None
+
+    def __enter__(self):
+        metrics = Metrics.instance()
+        self.outer = metrics.current_handler
+        metrics.current_handler = metrics.last_handler = self.name
+        self.timing.segment_begin = time.time()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.timing.close_segment()
+        self.timing.segment_begin = 0
+        Metrics.instance().current_handler = self.outer
+
+
+@contextlib.contextmanager
+def _no_context():
+    yield
+
+
+def handler_context(name, timing):
+    """
+    context running every IOLoop callback of a handler in a HandlerContext
+    does nothing when the hooks are off
+    """
+    if not HOOKS_ENABLED:
+        return _no_context()
+    return tornado.stack_context.StackContext(lambda: HandlerContext(name, timing))
+
+
+class SlowCallbackDetector(object):
+    """
+    SlowCallbackDetector
+    logs every IOLoop callback running longer than threshold seconds,
+    with the name of the handler it ran for
+    """
+    def __init__(self, threshold):
+        object.__init__(self)
+        self.threshold = threshold
+        self.io_loop = None
+
+    def install(self, io_loop):
+        if not HOOKS_ENABLED:
+            app_log.warning("slow IOLoop callbacks are not detected on tornado %s, see core.metrics",
+                            tornado.version)
+            return
+        # _run_callback is what every callback, timeout and future
+        # callback of the loop goes through
+        if getattr(io_loop, '_slow_callback_detector', None) is not None:
+            io_loop._slow_callback_detector.threshold = self.threshold
+            return
+        run_callback = io_loop._run_callback
+        metrics = Metrics.instance()
+        detector = self
+
+        def timed_run_callback(callback):
+            metrics.last_handler = None
+            begin = time.time()
+            try:
+                return run_callback(callback)
+            finally:
+                elapsed = time.time() - begin
+                if elapsed >= detector.threshold:
+                    detector.report(callback, elapsed)
+        io_loop._run_callback = timed_run_callback
+        io_loop._slow_callback_detector = self
+        self.io_loop = io_loop
+
+    def report(self, callback, elapsed):
+        metrics = Metrics.instance()
+        # the handler context has been left by now
+        handler = metrics.last_handler if metrics.last_handler is not None else \
+            getattr(callback, '__name__', None) or repr(callback)
+        metrics.observe_slow_callback(handler, elapsed)
+        app_log.warning("slow IOLoop callback: %.1f ms in %s", elapsed * 1000, handler)
@@ -7,63 +7,167 @@ core.models
 
 __author__ = 'Rnd495'
 
+import os
+import time
 import datetime
-import hashlib
+import itertools
 
-from sqlalchemy import create_engine
-from sqlalchemy.schema import MetaData, Table
+from sqlalchemy import create_engine, event, exc, DateTime
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import Table
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm.attributes import get_history
 
+import metrics
+import password
+import schema_snapshot
+from cache import LRUCache
 from configs import Configs
 
 
+def _format_datetime(val):
+    if isinstance(val, datetime.datetime):
+        return val.strftime(_Base.DATETIME_FORMAT)
+    return val
+
+
 class _Base(object):
     """
     Declarative base
     """
     DATETIME_FORMAT = '%Y/%m/%d %H:%M:%S'
 
-    def to_dict(self):
+    @classmethod
+    def get_serializer(cls, include=None, exclude=None):
+        """
+        (attribute name, formatter or None) of every column
+        built from __table__.columns once per class and field selection
+        :param include: iterable of field names or None for all
+        :param exclude: iterable of field names or None
+        :return: tuple
+        """
+        serializers = cls.__dict__.get('_serializers', None)
+        if serializers is None:
+            serializers = {}
+            setattr(cls, '_serializers', serializers)
+        key = (frozenset(include) if include is not None else None, frozenset(exclude or ()))
+        serializer = serializers.get(key, None)
+        if serializer is None:
+            serializer = []
+            for column in cls.__table__.columns:
+                field = cls.__mapper__.get_property_by_column(column).key
+                if include is not None and field not in include or field in key[1]:
+                    continue
+                formatter = _format_datetime if isinstance(column.type, DateTime) else None
+                serializer.append((field, formatter))
+            serializer = serializers[key] = tuple(serializer)
+        return serializer
+
+    def to_dict(self, include=None, exclude=None):
         fields = {}
-        for field in dir(self):
-            # those are not field
-            if field.startswith('_') or field in ['metadata', 'DATETIME_FORMAT']:
-                continue
-            val = self.__getattribute__(field)
-            # dirty way to remove functions
-            if callable(val):
-                continue
-            # format datetime to text
-            if isinstance(val, datetime.datetime):
-                val = val.strftime(self.DATETIME_FORMAT)
-            # format children metadata
-            elif isinstance(val, Base):
-                val = val.to_dict()
-            fields[field] = val
+        for field, formatter in self.get_serializer(include, exclude):
+            val = getattr(self, field)
+            fields[field] = formatter(val) if formatter is not None else val
         return fields
 
+    @classmethod
+    def to_dicts(cls, rows, include=None, exclude=None):
+        serializer = cls.get_serializer(include, exclude)
+        result = []
+        for row in rows:
+            fields = {}
+            for field, formatter in serializer:
+                val = getattr(row, field)
+                fields[field] = formatter(val) if formatter is not None else val
+            result.append(fields)
+        return result
+
 
 configs = Configs.instance()
-meta = MetaData()
+# tables of the schema snapshot, missing ones are reflected in get_table
+meta = schema_snapshot.load()
 Base = declarative_base(cls=_Base)
 
 _engine = None
 _session_maker = None
 _session = None
+_pool_stats = dict(connect=0, checkout=0, checkin=0, wait_count=0, wait_time=0.0, wait_max=0.0)
+
+
+class MeteredQueuePool(QueuePool):
+    """
+    QueuePool recording the time spent waiting for a connection
+    """
+    def _do_get(self):
+        begin = time.time()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            wait = time.time() - begin
+            _pool_stats['wait_count'] += 1
+            _pool_stats['wait_time'] += wait
+            _pool_stats['wait_max'] = max(_pool_stats['wait_max'], wait)
+
+
+def _count_pool_event(name):
+    def listener(*args):
+        _pool_stats[name] += 1
+    return listener
+
+
+def _record_connection_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+def _check_connection_pid(dbapi_connection, connection_record, connection_proxy):
+    """
+    never hand a connection opened by a parent process to a forked worker
+    """
+    pid = os.getpid()
+    if connection_record.info.get('pid', pid) != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            "Connection record belongs to pid %s, attempting to check out in pid %s" %
+            (connection_record.info['pid'], pid))
 
 
 def get_engine():
     global _engine
     if not _engine:
-        _engine = create_engine(
-            configs.database_url,
-            encoding=configs.database_encoding,
-            echo=False)
-        Base.metadata.create_all(_engine)
+        options = dict(encoding=configs.database_encoding, echo=False)
+        # sqlite uses its own single connection pools
+        if not make_url(configs.database_url).drivername.startswith('sqlite'):
+            options.update(
+                poolclass=MeteredQueuePool,
+                pool_size=configs.database_pool_size,
+                max_overflow=configs.database_max_overflow,
+                pool_timeout=configs.database_pool_timeout,
+                pool_recycle=configs.database_pool_recycle,
+                pool_pre_ping=configs.database_pool_pre_ping)
+        _engine = create_engine(configs.database_url, **options)
+        for name in ('connect', 'checkout', 'checkin'):
+            event.listen(_engine, name, _count_pool_event(name))
+        event.listen(_engine, 'connect', _record_connection_pid)
+        event.listen(_engine, 'checkout', _check_connection_pid)
+        if configs.metrics_enabled:
+            metrics.instrument_engine(_engine)
     return _engine
 
 
+def get_pool_stats():
+    """
+    connection pool metrics
+    :return: dict
+    """
+    stats = dict(_pool_stats)
+    pool = get_engine().pool
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(), checked_out=pool.checkedout(), overflow=pool.overflow())
+    return stats
+
+
 def get_session_maker():
     global _session_maker
     if not _session_maker:
@@ -78,36 +182,139 @@ def get_global_session():
     return _session
 
 
-def get_new_session():
-    return get_session_maker()()
+def get_new_session(**kwargs):
+    return get_session_maker()(**kwargs)
 
 
-class User(Base):
-    __table__ = Table("t_user", meta, autoload=True, autoload_with=get_engine())
+def run_in_session(function, *args, **kwargs):
+    """
+    call function(session, *args, **kwargs) with a new session
+    commit on success and rollback on error
+    objects returned stay loaded but are detached from the closed session
+    meant to be run in core.executors.get_database_pool()
+    """
+    session = get_new_session(expire_on_commit=False)
+    try:
+        result = function(session, *args, **kwargs)
+        session.commit()
+        return result
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+# detached User records by user_id, see UI.Page.PageBase.query_user
+user_cache = LRUCache(configs.user_cache_size, configs.user_cache_ttl)
+
+
+def invalidate_user(user_id):
+    """
+    drop the cached record of a user, call it whenever the user row changes
+    """
+    if user_id is not None:
+        user_cache.pop(int(user_id))
+        bump_version('user', int(user_id))
+
+
+# versions of groups of rows, e.g. ('monsters', owner_id), see get_version
+_versions = {}
+_version_counter = itertools.count(1)
+# tells versions of different runs apart, shared by the workers of a run, see set_version_epoch
+_version_epoch = os.urandom(4).encode('hex')
+
 
-    def __init__(self, name, pwd,
-                 user_id=None, role_id=3, header_url=None):
+def set_version_epoch(epoch):
+    """
+    use the epoch of the supervisor, so an ETag issued by one worker is current in the others
+    """
+    global _version_epoch
+    _version_epoch = epoch
+
+
+def bump_version(*key):
+    _versions[key] = next(_version_counter)
+
+
+def get_version(*key):
+    """
+    token of the rows grouped under key, changes whenever they are changed
+    through this process, and at least every version_ttl seconds
+    for changes made by other processes, the same bound as user_cache_ttl
+    workers count versions on their own, equal counts of two workers pass
+    for the same version within that bound too
+    :return: str
+    """
+    return '%s.%d.%d' % (_version_epoch, _versions.get(key, 0), int(time.time() // configs.version_ttl))
+
+
+def get_table(name):
+    """
+    table from the schema snapshot
+    reflected from the database only when the snapshot does not have it
+    :param name: table name
+    :return: Table
+    """
+    table = meta.tables.get(name, None)
+    if table is None:
+        table = Table(name, meta, autoload=True, autoload_with=get_engine())
+    return table
+
+
+class User(Base):
+    __table__ = get_table("t_user")
+
+    def __init__(self, name, pwd=None,
+                 user_id=None, role_id=3, header_url=None, pwd_hash=None):
+        """
+        :param pwd: plain password, hashed here
+        :param pwd_hash: password already hashed by core.password, e.g. in the password pool
+        """
         self.user_name = name
-        self.user_pass = User.password_hash(pwd)
+        self.user_pass = pwd_hash if pwd_hash is not None else User.password_hash(pwd)
         self.user_register_time = datetime.datetime.now()
         self.user_role_id = role_id
         self.user_header_url = header_url
         if user_id is not None:
             self.user_id = user_id
 
-    def get_is_same_password(self, password):
-        return User.password_hash(password) == self.user_pass
+    def get_is_same_password(self, password_text):
+        return password.get_hasher().verify(password_text, self.user_pass)
 
-    def set_password(self, password):
-        self.user_pass = User.password_hash(password)
+    def set_password(self, password_text):
+        self.user_pass = User.password_hash(password_text)
+        invalidate_user(self.user_id)
 
     @staticmethod
     def password_hash(text):
-        return hashlib.sha256(text + configs.user_password_hash_salt).hexdigest()
+        return password.hash_password(text)
+
+
+class UserIdentity(object):
+    """
+    UserIdentity
+    identity fields of a User, carried in the "user_identity" secure cookie
+    stands in for current_user when the full record is not needed
+    """
+    __slots__ = ('user_id', 'user_name', 'user_role_id')
+    FIELDS = __slots__
+
+    def __init__(self, user_id, user_name, user_role_id):
+        self.user_id = user_id
+        self.user_name = user_name
+        self.user_role_id = user_role_id
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(*[getattr(user, field) for field in cls.FIELDS])
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
 
 
 class Role(Base):
-    __table__ = Table("t_role", meta, autoload=True, autoload_with=get_engine())
+    __table__ = get_table("t_role")
 
     def __init__(self, name, role_id=None):
         self.role_name = name
@@ -116,43 +323,76 @@ class Role(Base):
 
 
 class Skill(Base):
-    __table__ = Table("t_skill", meta, autoload=True, autoload_with=get_engine())
+    __table__ = get_table("t_skill")
 
 
 class SkillType(Base):
-    __table__ = Table("t_skill_type", meta, autoload=True, autoload_with=get_engine())
+    __table__ = get_table("t_skill_type")
 
 
 class SkillTargetType(Base):
-    __table__ = Table("t_skill_target_type", meta, autoload=True, autoload_with=get_engine())
+    __table__ = get_table("t_skill_target_type")
 
 
 class SPSkill(Base):
-    __table__ = Table("t_sp_skill", meta, autoload=True, autoload_with=get_engine())
+    __table__ = get_table("t_sp_skill")
 
 
 class Monster(Base):
-    __table__ = Table("t_monster", meta, autoload=True, autoload_with=get_engine())
+    __table__ = get_table("t_monster")
+
+    # the tables have no foreign keys, so the joins are spelled out
+    monster_type = relationship(
+        'MonsterType', viewonly=True,
+        primaryjoin='foreign(Monster.monster_type_id) == MonsterType.monster_type_id')
+    element = relationship(
+        'Element', viewonly=True,
+        primaryjoin='foreign(Monster.monster_element_id) == Element.element_id')
+    skills = relationship(
+        'Skill', viewonly=True, secondary=lambda: MonsterHasSkill.__table__, order_by='Skill.skill_id',
+        primaryjoin='Monster.monster_id == foreign(MonsterHasSkill.monster_id)',
+        secondaryjoin='foreign(MonsterHasSkill.skill_id) == Skill.skill_id')
+
+
+def _bump_monster_version(mapper, connection, target):
+    bump_version('monsters', target.monster_owner_id)
+    for owner_id in get_history(target, 'monster_owner_id').deleted or ():
+        bump_version('monsters', owner_id)
+
+
+def _bump_monster_skill_version(mapper, connection, target):
+    owner_id = connection.scalar(
+        Monster.__table__.select().with_only_columns([Monster.__table__.c.monster_owner_id]).where(
+            Monster.__table__.c.monster_id == target.monster_id))
+    bump_version('monsters', owner_id)
+
+
+for _event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Monster, _event_name, _bump_monster_version)
 
 
 class MonsterType(Base):
-    __table__ = Table("t_monster_type", meta, autoload=True, autoload_with=get_engine())
+    __table__ = get_table("t_monster_type")
 
 
 class MonsterHasEquipment(Base):
-    __table__ = Table("t_monster_has_equipment", meta, autoload=True, autoload_with=get_engine())
+    __table__ = get_table("t_monster_has_equipment")
 
 
 class MonsterHasSkill(Base):
-    __table__ = Table("t_monster_has_skill", meta, autoload=True, autoload_with=get_engine())
+    __table__ = get_table("t_monster_has_skill")
+
+
+for _event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(MonsterHasSkill, _event_name, _bump_monster_skill_version)
 
 
 class MonsterHasSPSkill(Base):
-    __table__ = Table("t_monster_has_sp_skill", meta, autoload=True, autoload_with=get_engine())
+    __table__ = get_table("t_monster_has_sp_skill")
 
 
 class Element(Base):
-    __table__ = Table("t_element", meta, autoload=True, autoload_with=get_engine())
+    __table__ = get_table("t_element")
 
     def __init__(self, name, element_id=None):
         self.element_name = name
@@ -161,7 +401,7 @@ class Element(Base):
 
 
 class ElementVSElement(Base):
-    __table__ = Table("t_element_vs_element", meta, autoload=True, autoload_with=get_engine())
+    __table__ = get_table("t_element_vs_element")
 
     def __init__(self, atk_element_id, def_element_id, effect=1.0):
         self.atk_element_id = atk_element_id
@@ -170,4 +410,4 @@ class ElementVSElement(Base):
 
 
 class Equipment(Base):
-    __table__ = Table("t_element", meta, autoload=True, autoload_with=get_engine())
\ No newline at end of file
+    __table__ = get_table("t_element")
\ No newline at end of file
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+core.password
+
+password hashes are stored as "<algorithm>$<cost>$<salt>$<hash hex>"
+hashes without "$" are legacy salted sha256 hex digests, they are
+upgraded on the next successful login
+the config "user_password_hash_salt" is appended to every password as pepper
+legacy schemas size the password column for 64 chars, see check_column
+"""
+
+__author__ = 'Rnd495'
+__all__ = ['PasswordHasher', 'get_hasher', 'hash_password', 'verify_password', 'check_column']
+
+import os
+import hmac
+import hashlib
+import binascii
+
+from tornado.log import app_log
+
+from configs import Configs
+
+configs = Configs.instance()
+
+
+class PasswordHasher(object):
+    """
+    PasswordHasher
+    algorithm "pbkdf2_sha256": cost is the iteration count
+    algorithm "scrypt": cost is log2 of N, needs hashlib.scrypt
+    """
+    ALGORITHMS = ('pbkdf2_sha256', 'scrypt')
+    DIGEST_SIZES = {'pbkdf2_sha256': 32, 'scrypt': 64}
+
+    def __init__(self, algorithm, cost, pepper='', salt_size=16):
+        object.__init__(self)
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError('ValueError: unknown password hash algorithm "%s"' % algorithm)
+        if algorithm == 'scrypt' and not hasattr(hashlib, 'scrypt'):
+            raise ValueError('ValueError: hashlib.scrypt is not available in this python')
+        self.algorithm = algorithm
+        self.cost = cost
+        self.pepper = pepper
+        self.salt_size = salt_size
+
+    def derive(self, algorithm, cost, password, salt):
+        password = self._to_bytes(password) + self._to_bytes(self.pepper)
+        if algorithm == 'pbkdf2_sha256':
+            return hashlib.pbkdf2_hmac('sha256', password, salt, cost)
+        elif algorithm == 'scrypt':
+            return hashlib.scrypt(password, salt=salt, n=2 ** cost, r=8, p=1, maxmem=2 ** (cost + 11))
+        raise ValueError('ValueError: unknown password hash algorithm "%s"' % algorithm)
+
+    def encode(self, password):
+        salt = binascii.hexlify(os.urandom(self.salt_size // 2))
+        digest = self.derive(self.algorithm, self.cost, password, salt)
+        return '%s$%d$%s$%s' % (self.algorithm, self.cost, salt, binascii.hexlify(digest))
+
+    def legacy_encode(self, password):
+        return hashlib.sha256(self._to_bytes(password) + self._to_bytes(self.pepper)).hexdigest()
+
+    def verify(self, password, encoded):
+        if not encoded:
+            return False
+        if '$' not in encoded:
+            expected = self.legacy_encode(password)
+        else:
+            try:
+                algorithm, cost, salt, _ = encoded.split('$')
+                if algorithm == 'scrypt' and not hasattr(hashlib, 'scrypt'):
+                    app_log.error("scrypt password hash, but hashlib.scrypt is not available in this python")
+                    return False
+                digest = self.derive(algorithm, int(cost), password, self._to_bytes(salt))
+            except ValueError:
+                return False
+            expected = '%s$%s$%s$%s' % (algorithm, cost, salt, binascii.hexlify(digest))
+        return hmac.compare_digest(self._to_bytes(expected), self._to_bytes(encoded))
+
+    def encoded_length(self):
+        """
+        :return: int, length of the strings encode returns
+        """
+        return len('%s$%d$' % (self.algorithm, self.cost)) + self.salt_size + 1 + \
+            self.DIGEST_SIZES[self.algorithm] * 2
+
+    def needs_upgrade(self, encoded):
+        return not encoded.startswith('%s$%d$' % (self.algorithm, self.cost))
+
+    @staticmethod
+    def _to_bytes(text):
+        return text.encode('utf-8') if isinstance(text, unicode) else text
+
+
+_hasher = None
+
+
+def get_hasher():
+    """
+    PasswordHasher configured by "password_hash_algorithm" and "password_hash_cost"
+    """
+    global _hasher
+    if _hasher is None:
+        _hasher = PasswordHasher(
+            configs.password_hash_algorithm,
+            configs.password_hash_cost,
+            configs.user_password_hash_salt)
+    return _hasher
+
+
+def hash_password(password):
+    return get_hasher().encode(password)
+
+
+def verify_password(password, encoded):
+    """
+    module level so it can run in core.executors.get_password_pool()
+    :return: (ok, upgraded hash or None)
+    """
+    hasher = get_hasher()
+    if not hasher.verify(password, encoded):
+        return False, None
+    if hasher.needs_upgrade(encoded):
+        return True, hasher.encode(password)
+    return True, None
+
+
+def check_column(column):
+    """
+    fail the startup when the column storing the hashes is too short for them
+    a truncated hash locks its user out, strict databases reject it instead
+    :param column: sqlalchemy Column, e.g. User.__table__.c.user_pass
+    """
+    length = getattr(column.type, 'length', None)
+    needed = get_hasher().encoded_length()
+    if length is not None and length < needed:
+        raise ValueError(
+            'ValueError: column %s holds %d chars, "%s" password hashes need %d, widen it before starting'
+            % (column, length, configs.password_hash_algorithm, needed))
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+core.profiler
+on demand sampling profiler of the threads of this process
+
+a profile samples the stack of every thread for a bounded time and counts
+them in the collapsed format of flamegraph.pl:
+    <thread>;<handler>;<outermost frame>;...;<innermost frame> <count>
+samples of the IOLoop thread belong to the handler of the running callback,
+see core.metrics.HandlerContext, samples of database pool threads to the
+handler they run a query for, see core.metrics.bind
+nothing runs while no profile is being taken
+process pools are separate processes and are not sampled
+"""
+
+__author__ = 'Rnd495'
+__all__ = ['Profile', 'Profiler']
+
+import os
+import sys
+import time
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# innermost frames of a thread waiting for work
+_IDLE_FRAMES = {
+    ('ioloop.py', 'start'),
+    ('threading.py', 'wait'),
+    ('Queue.py', 'get'),
+    # result threads of the process pools
+    ('queues.py', 'get'),
+    ('thread.py', '_worker'),
+}
+
+
+def _format_frame(code):
+    # the first line keeps every sample of a function together
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Profile(object):
+    """
+    Profile
+    stack counts of one profiling run
+    """
+    def __init__(self, interval, include_idle=False):
+        object.__init__(self)
+        self.interval = interval
+        self.include_idle = include_idle
+        # collapsed stack -> count
+        self.stacks = {}
+        # handler -> count
+        self.handlers = {}
+        self.samples = 0
+        self.idle = 0
+        self.begin = None
+        self.end = None
+
+    def sample(self, ioloop_ident, handler_names, exclude_ident):
+        """
+        count the current stack of every thread but exclude_ident
+        """
+        thread_names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        current_handler = metrics.Metrics.instance().current_handler
+        for ident, frame in sys._current_frames().items():
+            if ident == exclude_ident:
+                continue
+            leaf = frame.f_code
+            if ident == ioloop_ident:
+                thread_name = 'ioloop'
+                handler = current_handler
+            else:
+                thread_name = thread_names.get(ident, str(ident))
+                handler = metrics.bound_handlers.get(ident, None)
+            if handler is None and (os.path.basename(leaf.co_filename), leaf.co_name) in _IDLE_FRAMES:
+                self.idle += 1
+                if not self.include_idle:
+                    continue
+            frames = []
+            while frame is not None:
+                frames.append(_format_frame(frame.f_code))
+                frame = frame.f_back
+            frames.append(handler_names.get(handler, handler) if handler is not None else '-')
+            frames.append(thread_name)
+            frames.reverse()
+            stack = ';'.join(frame_name.replace(';', ':') for frame_name in frames)
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            handler_key = frames[1]
+            self.handlers[handler_key] = self.handlers.get(handler_key, 0) + 1
+            self.samples += 1
+
+    def collapsed(self):
+        """
+        :return: str, one "stack count" line per stack, most sampled first
+        """
+        lines = ['%s %d' % (stack, count)
+                 for stack, count in sorted(self.stacks.iteritems(), key=lambda item: (-item[1], item[0]))]
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def to_dict(self):
+        return dict(interval=self.interval, seconds=round((self.end or time.time()) - self.begin, 3),
+                    samples=self.samples, idle=self.idle, handlers=self.handlers, stacks=self.stacks)
+
+
+class Profiler(object):
+    """
+    Profiler
+    takes one profile at a time, in a thread of its own
+    """
+    def __init__(self):
+        object.__init__(self)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.running = None
+
+    def start(self, seconds, interval, handler_names=None, include_idle=False):
+        """
+        profile every thread for seconds, call it on the IOLoop thread
+        :param interval: seconds between samples
+        :param handler_names: handler name -> label, e.g. its mapped path
+        :return: concurrent.futures.Future of the Profile, None if a profile is already running
+        """
+        if self.running is not None:
+            return None
+        profile = Profile(interval, include_idle)
+        self.running = profile
+        future = self.executor.submit(
+            self._run, profile, seconds, threading.current_thread().ident, handler_names or {})
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        self.running = None
+
+    @staticmethod
+    def _run(profile, seconds, ioloop_ident, handler_names):
+        own_ident = threading.current_thread().ident
+        profile.begin = time.time()
+        deadline = profile.begin + seconds
+        next_sample = profile.begin
+        while True:
+            profile.sample(ioloop_ident, handler_names, own_ident)
+            next_sample += profile.interval
+            now = time.time()
+            if now >= deadline:
+                break
+            # samples behind schedule are skipped instead of taken in a burst
+            if next_sample < now:
+                next_sample = now
+            time.sleep(min(next_sample, deadline) - now)
+        profile.end = time.time()
+        return profile
+
+    @classmethod
+    def instance(cls):
+        if not hasattr(cls, '__instance__'):
+            cls.__instance__ = cls()
+        return cls.__instance__
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+core.schema_snapshot
+
+pickled MetaData of the reflected database schema
+core.models maps its tables from the snapshot, so importing it needs no
+database round trip
+regenerate after every schema change:
+    python -m core.schema_snapshot
+"""
+
+__author__ = 'Rnd495'
+
+import os
+import pickle
+import logging
+
+from sqlalchemy import create_engine
+from sqlalchemy.schema import MetaData
+
+from configs import Configs, ROOT_PATH
+
+configs = Configs.instance()
+
+
+def get_snapshot_path():
+    if not configs.database_schema_snapshot:
+        return None
+    return os.path.join(ROOT_PATH, configs.database_schema_snapshot)
+
+
+def load():
+    """
+    load the schema snapshot
+    :return: MetaData, empty if there is no usable snapshot
+    """
+    path = get_snapshot_path()
+    if path and os.path.exists(path):
+        try:
+            with open(path, 'rb') as file_handle:
+                return pickle.load(file_handle)
+        except Exception:
+            logging.exception('schema snapshot "%s" is broken, reflecting from database', path)
+    return MetaData()
+
+
+def dump(engine, path):
+    """
+    reflect every table of engine and pickle it to path
+    :return: MetaData
+    """
+    meta = MetaData()
+    meta.reflect(bind=engine)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file_handle:
+        pickle.dump(meta, file_handle, pickle.HIGHEST_PROTOCOL)
+    # replace atomically, running workers may read it
+    os.rename(temp_path, path)
+    return meta
+
+
+if __name__ == '__main__':
+    snapshot_path = get_snapshot_path()
+    if not snapshot_path:
+        raise SystemExit('config "database_schema_snapshot" is not set')
+    snapshot = dump(create_engine(configs.database_url, encoding=configs.database_encoding), snapshot_path)
+    print "snapshot:", snapshot_path
+    for table_name in sorted(snapshot.tables):
+        print table_name
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+core.supervisor
+forks worker processes and keeps them alive
+
+SIGHUP restarts the workers one by one, each old worker is stopped only
+once its successor reports ready, so the listening sockets are never
+left without a worker
+workers import the application after the fork, so a restarted worker runs
+the code and config on disk, the supervisor keeps them out of its own
+process, see run_forked
+SIGTERM and SIGINT stop every worker and exit
+workers report their health as json lines on a pipe, see Heartbeat
+"""
+
+__author__ = 'Rnd495'
+__all__ = ['Supervisor', 'Heartbeat', 'RequestCounter', 'run_forked']
+
+import os
+import json
+import time
+import errno
+import fcntl
+import select
+import signal
+import traceback
+
+import tornado.ioloop
+import tornado.httputil
+from tornado.log import app_log
+
+
+def _set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+def run_forked(function):
+    """
+    run function in a child process and wait for it
+    the modules it imports are never loaded in this process
+    :return: exit status of the child, 0 on success
+    """
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            function()
+        except:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+    while True:
+        try:
+            _, status = os.waitpid(pid, 0)
+            return status
+        except OSError as error:
+            if error.errno != errno.EINTR:
+                raise
+
+
+class WorkerHandle(object):
+    """
+    WorkerHandle
+    what the supervisor knows about one worker
+    """
+    __slots__ = ('pid', 'slot', 'read_fd', 'buffer', 'started', 'last_heartbeat', 'health', 'ready', 'stopping')
+
+    def __init__(self, pid, slot, read_fd):
+        self.pid = pid
+        self.slot = slot
+        self.read_fd = read_fd
+        self.buffer = ''
+        self.started = time.time()
+        self.last_heartbeat = None
+        self.health = {}
+        self.ready = False
+        self.stopping = False
+
+
+class Supervisor(object):
+    """
+    Supervisor
+    worker_main(slot, heartbeat_fd) runs in every forked worker
+    """
+    def __init__(self, worker_main, processes, heartbeat_timeout=10, health_log_interval=60):
+        object.__init__(self)
+        self.worker_main = worker_main
+        self.processes = processes
+        self.heartbeat_timeout = heartbeat_timeout
+        self.health_log_interval = health_log_interval
+        self.workers = {}
+        self.respawn_after = {}
+        self.last_spawn = {}
+        self.restart_queue = []
+        self.replacing = None
+        self.reload_requested = False
+        self.stop_requested = False
+        # shared by the workers forked since the start or the last SIGHUP, e.g. for ETags
+        self.epoch = os.urandom(4).encode('hex')
+        self.last_health_log = time.time()
+
+    def spawn(self, slot):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                # a group of its own, so that the pool processes of a killed
+                # worker can be killed along with it, see reap
+                os.setpgid(0, 0)
+                os.close(read_fd)
+                for worker in self.workers.itervalues():
+                    os.close(worker.read_fd)
+                for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                    signal.signal(sig, signal.SIG_DFL)
+                self.worker_main(slot, write_fd)
+            except:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(write_fd)
+        _set_nonblocking(read_fd)
+        self.last_spawn[slot] = time.time()
+        self.workers[pid] = WorkerHandle(pid, slot, read_fd)
+        app_log.info("worker %d started, pid %d", slot, pid)
+        return pid
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self.on_reload_signal)
+        signal.signal(signal.SIGTERM, self.on_stop_signal)
+        signal.signal(signal.SIGINT, self.on_stop_signal)
+        for slot in range(self.processes):
+            self.spawn(slot)
+        while not self.stop_requested:
+            self.read_heartbeats(1.0)
+            self.reap()
+            self.check_heartbeats()
+            if self.reload_requested:
+                self.reload_requested = False
+                self.epoch = os.urandom(4).encode('hex')
+                self.restart_queue = [pid for pid, worker in self.workers.iteritems() if not worker.stopping]
+            self.continue_restart()
+            if time.time() - self.last_health_log >= self.health_log_interval:
+                self.log_health()
+        self.stop_all()
+
+    def on_reload_signal(self, signum, frame):
+        self.reload_requested = True
+
+    def on_stop_signal(self, signum, frame):
+        self.stop_requested = True
+
+    def read_heartbeats(self, timeout):
+        fds = dict((worker.read_fd, worker) for worker in self.workers.itervalues())
+        try:
+            readable, _, _ = select.select(list(fds), [], [], timeout)
+        except (select.error, OSError) as error:
+            if error.args[0] != errno.EINTR:
+                raise
+            return
+        for fd in readable:
+            worker = fds[fd]
+            try:
+                data = os.read(fd, 65536)
+            except OSError as error:
+                if error.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise
+                continue
+            worker.buffer += data
+            lines = worker.buffer.split('\n')
+            worker.buffer = lines.pop()
+            for line in lines:
+                try:
+                    worker.health = json.loads(line)
+                except ValueError:
+                    continue
+                worker.last_heartbeat = time.time()
+                if worker.health.get('ready') and not worker.ready:
+                    worker.ready = True
+                    app_log.info("worker %d ready, pid %d", worker.slot, worker.pid)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                if error.errno != errno.ECHILD:
+                    raise
+                pid = 0
+            if not pid:
+                break
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            os.close(worker.read_fd)
+            # leftovers of the worker, e.g. pool processes still holding the sockets
+            self.kill(-pid, signal.SIGKILL)
+            if worker.stopping:
+                app_log.info("worker %d stopped, pid %d", worker.slot, pid)
+                continue
+            app_log.warning("worker %d exited unexpectedly with status %d, pid %d", worker.slot, status, pid)
+            if self.replacing is not None and pid == self.replacing[1]:
+                # the old worker keeps serving
+                app_log.error("rolling restart aborted, worker %d failed to start", worker.slot)
+                self.replacing = None
+                self.restart_queue = []
+                continue
+            if self.replacing is not None and pid == self.replacing[0]:
+                # the successor takes over the slot
+                self.replacing = None
+                continue
+            # do not fork in a tight loop when the worker dies at start
+            self.respawn_after[worker.slot] = max(time.time(), self.last_spawn.get(worker.slot, 0) + 1)
+        now = time.time()
+        for slot, after in self.respawn_after.items():
+            if after <= now and not self.stop_requested:
+                del self.respawn_after[slot]
+                self.spawn(slot)
+
+    def check_heartbeats(self):
+        now = time.time()
+        for worker in self.workers.values():
+            last = worker.last_heartbeat or worker.started
+            if not worker.stopping and now - last > self.heartbeat_timeout:
+                app_log.error("worker %d missed its heartbeats for %.1fs, killing pid %d",
+                              worker.slot, now - last, worker.pid)
+                self.kill(-worker.pid, signal.SIGKILL)
+
+    def continue_restart(self):
+        """
+        rolling restart, one worker at a time
+        """
+        if self.replacing is not None:
+            old_pid, new_pid = self.replacing
+            new_worker = self.workers.get(new_pid, None)
+            if new_worker is None or not new_worker.ready:
+                return
+            self.stop(old_pid)
+            self.replacing = None
+        while self.restart_queue and self.replacing is None:
+            old_pid = self.restart_queue.pop(0)
+            old_worker = self.workers.get(old_pid, None)
+            if old_worker is None or old_worker.stopping:
+                continue
+            self.replacing = (old_pid, self.spawn(old_worker.slot))
+
+    def stop(self, pid):
+        worker = self.workers.get(pid, None)
+        if worker is not None:
+            worker.stopping = True
+            self.kill(pid, signal.SIGTERM)
+
+    @staticmethod
+    def kill(pid, sig):
+        """
+        :param pid: negative for the process group of a worker
+        """
+        try:
+            os.kill(pid, sig)
+        except OSError as error:
+            if error.errno != errno.ESRCH:
+                raise
+
+    def stop_all(self, timeout=30):
+        for pid in list(self.workers):
+            self.stop(pid)
+        deadline = time.time() + timeout
+        while self.workers and time.time() < deadline:
+            self.read_heartbeats(0.1)
+            self.reap()
+        for pid in list(self.workers):
+            self.kill(-pid, signal.SIGKILL)
+
+    def get_health(self):
+        """
+        :return: list of dict, one per worker
+        """
+        now = time.time()
+        result = []
+        for worker in sorted(self.workers.itervalues(), key=lambda w: w.slot):
+            health = dict(worker.health)
+            health.update(slot=worker.slot, pid=worker.pid, ready=worker.ready, stopping=worker.stopping,
+                          heartbeat_age=round(now - worker.last_heartbeat, 3) if worker.last_heartbeat else None)
+            result.append(health)
+        return result
+
+    def log_health(self):
+        self.last_health_log = time.time()
+        for health in self.get_health():
+            app_log.info("worker %s", json.dumps(health, sort_keys=True))
+
+
+class _CountingDelegate(tornado.httputil.HTTPMessageDelegate):
+    """
+    counts a request once its headers arrive, start_request is also
+    called for the next request a keep-alive connection may never send
+    """
+    def __init__(self, counter, delegate):
+        self.counter = counter
+        self.delegate = delegate
+        self.counted = False
+        self.received = False
+
+    def headers_received(self, start_line, headers):
+        self.counted = True
+        self.counter.inflight += 1
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        return self.delegate.data_received(chunk)
+
+    def finish(self):
+        self.received = True
+        self.delegate.finish()
+
+    def on_connection_close(self):
+        # closed before the request was complete, no handler will finish it
+        if self.counted and not self.received:
+            self.counter.inflight -= 1
+        self.delegate.on_connection_close()
+
+
+class RequestCounter(object):
+    """
+    RequestCounter
+    requests served and in flight of a tornado.web.Application
+    """
+    def __init__(self, app):
+        object.__init__(self)
+        self.requests = 0
+        self.inflight = 0
+        start_request = app.start_request
+        log_request = app.log_request
+
+        def counting_start_request(server_conn, request_conn):
+            return _CountingDelegate(self, start_request(server_conn, request_conn))
+
+        def counting_log_request(handler):
+            self.inflight = max(self.inflight - 1, 0)
+            self.requests += 1
+            log_request(handler)
+        app.start_request = counting_start_request
+        app.log_request = counting_log_request
+
+
+class Heartbeat(object):
+    """
+    Heartbeat
+    reports the health of a worker to its supervisor every interval seconds
+    """
+    def __init__(self, fd, slot, counter, interval=1):
+        object.__init__(self)
+        self.fd = fd
+        self.slot = slot
+        self.counter = counter
+        self.interval = interval
+        self.started = time.time()
+        self.max_lag = 0.0
+        self.expected = None
+        self.callback = None
+        _set_nonblocking(fd)
+
+    def start(self):
+        self.callback = tornado.ioloop.PeriodicCallback(self.beat, self.interval * 1000)
+        self.callback.start()
+        self.beat()
+
+    def beat(self):
+        now = time.time()
+        # how late this callback runs is how long the IOLoop was blocked
+        lag = max(now - self.expected, 0.0) if self.expected is not None else 0.0
+        self.expected = now + self.interval
+        self.max_lag = max(self.max_lag, lag)
+        line = json.dumps(dict(pid=os.getpid(), slot=self.slot, ready=True,
+                               requests=self.counter.requests, inflight=self.counter.inflight,
+                               uptime=round(now - self.started, 1), lag_ms=round(lag * 1000, 2),
+                               max_lag_ms=round(self.max_lag * 1000, 2)))
+        try:
+            os.write(self.fd, line + '\n')
+        except OSError as error:
+            # a busy supervisor must never block the worker
+            if error.errno not in (errno.EAGAIN, errno.EPIPE):
+                raise
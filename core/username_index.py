@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# coding = utf-8
+
+"""
+core.username_index
+"""
+
+__author__ = 'Rnd495'
+
+import models
+
+
+class UsernameIndex(object):
+    """
+    UsernameIndex
+    lower cased names of t_user, warmed once and updated on registration
+    a name missing from the index is free, unless another process
+    registered it after warm(), so registration still asks the database
+    """
+    def __init__(self):
+        object.__init__(self)
+        self.names = set()
+        self.warmed = False
+        self.hits = 0
+        self.misses = 0
+
+    def warm(self, session):
+        self.names = set(name.lower() for name, in session.query(models.User.user_name))
+        self.warmed = True
+
+    def add(self, username):
+        self.names.add(username.lower())
+
+    def might_exist(self, username):
+        """
+        :return: False if username is certainly free, True if the database must be asked
+        """
+        if not self.warmed:
+            return True
+        if username.lower() in self.names:
+            self.misses += 1
+            return True
+        self.hits += 1
+        return False
+
+    def stats(self):
+        return dict(size=len(self.names), warmed=self.warmed, hits=self.hits, misses=self.misses)
+
+    @classmethod
+    def instance(cls):
+        if not hasattr(cls, '__instance__'):
+            cls.__instance__ = cls()
+        return cls.__instance__
@@ -6,12 +6,19 @@ core.verification
 """
 import functools
 import tornado.web
+import tornado.gen
+import tornado.concurrent
+import tornado.ioloop
 
 __author__ = 'Rnd495'
 
+import os
 import time
+import sqlite3
 import hashlib
 import random
+import threading
+import collections
 from cStringIO import StringIO
 try:
     # import from pillow
@@ -21,16 +28,42 @@ except ImportError:
     import Image
     import ImageDraw
     import ImageFont
+try:
+    # optional, used for the noise background
+    import numpy
+except ImportError:
+    numpy = None
+
+import executors
+from configs import Configs
+
+configs = Configs.instance()
+
+# renderers living in a process pool worker, built once per worker
+_worker_verifications = {}
+
+
+def _render_in_worker(options):
+    key = tuple(sorted(options.iteritems()))
+    verification = _worker_verifications.get(key, None)
+    if verification is None:
+        verification = _worker_verifications[key] = Verification(**options)
+    return verification.render()
 
 
 class Verification(object):
-    def __init__(self, available_count=10, available_time=60):
+    IMAGE_MIME_TYPES = {'png': 'image/png', 'gif': 'image/gif'}
+    CODE_ALIKE = {'O': '0', 'o': '0', 'I': '1', 'l': '1'}
+
+    def __init__(self, available_count=10, available_time=60, pool_size=0, pool_low_water=0,
+                 use_process_pool=False, image_format='png', image_palette=False, store=None,
+                 use_atlas=False, image_noise_percent=0):
         object.__init__(self)
         self.available_count = available_count
         self.available_time = available_time
         self.code_length = 4
         self.code_alpha = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
-        self.code_alike = {'O': '0', 'o': '0', 'I': '1', 'l': '1'}
+        self.code_alike = self.CODE_ALIKE
         self.code_color = ((20, 15, 50), (50, 15, 20), (15, 20, 50))
         self.image_size = (100, 40)
         self.image_background_color = (200, 200, 200, 200)
@@ -39,12 +72,33 @@ class Verification(object):
         self.image_offset = 10
         self.image_scalar = (0.8, 1.3)
         self.image_sample = Image.BICUBIC
+        self.image_format = image_format
+        self.image_palette = image_palette
+        self.image_palette_colors = 32
+        self.image_noise_percent = image_noise_percent
         self.case_sensitive = False
         self.random = random.Random()
-        self.container = {}
-        self.drop_size = 100
+        self.numpy_random = numpy.random.RandomState(self.random.getrandbits(32)) if numpy else None
+        self.store = store if store is not None else VerificationContainer(10000)
         self.char_image = {}
+        self.char_color = {}
         self.init_char_images()
+        # pre-transformed glyph masks, see init_char_atlas
+        self.use_atlas = use_atlas
+        self.atlas_scale_steps = 4
+        self.atlas_rotation_steps = 9
+        self.char_atlas = {}
+        if self.use_atlas:
+            self.init_char_atlas()
+        # pre-rendered (code, image) pool
+        self.pool = collections.deque()
+        self.pool_size = pool_size
+        self.pool_low_water = min(pool_low_water, pool_size)
+        self.pool_hit = 0
+        self.pool_miss = 0
+        self._pool_lock = threading.Lock()
+        self._pool_refilling = False
+        self.use_process_pool = use_process_pool
 
     def create_code(self):
         buf = []
@@ -60,74 +114,486 @@ class Verification(object):
             draw = ImageDraw.ImageDraw(image)
             draw.text((0, 0), c, color, self.image_font)
             self.char_image[c] = image
+            self.char_color[c] = color
 
-    def create_image(self, code):
+    def init_char_atlas(self):
+        """
+        resize and rotate every glyph once for a quantized set of scalars
+        and rotations, so create_image only has to pick one and paste it
+        only the alpha channel is kept, glyphs are pasted with char_color
+        """
+        def steps(begin, end, count):
+            if count <= 1:
+                return [(begin + end) / 2.0]
+            return [begin + (end - begin) * i / (count - 1.0) for i in range(count)]
+
+        scalars = steps(self.image_scalar[0], self.image_scalar[1], self.atlas_scale_steps)
+        rotations = steps(-self.image_rotation / 2.0, self.image_rotation / 2.0, self.atlas_rotation_steps)
+        for c, char_image in self.char_image.iteritems():
+            mask = char_image.split()[3]
+            variants = []
+            for scalar in scalars:
+                resize = (int(mask.size[0] * scalar), int(mask.size[1] * scalar))
+                scaled = mask.resize(resize, self.image_sample)
+                for rotation in rotations:
+                    variants.append(scaled.rotate(rotation, self.image_sample, True))
+            self.char_atlas[c] = variants
+
+    def create_background(self):
+        if not self.image_noise_percent:
+            return Image.new("RGBA", self.image_size, self.image_background_color)
+        width, height = self.image_size
+        if numpy is not None:
+            pixels = numpy.empty((height, width, 4), dtype=numpy.uint8)
+            pixels[:] = self.image_background_color
+            noise = self.numpy_random.randint(0, 100, (height, width)) < self.image_noise_percent
+            pixels[noise, :3] = self.numpy_random.randint(0, 256, (int(noise.sum()), 3))
+            return Image.fromarray(pixels, "RGBA")
         image = Image.new("RGBA", self.image_size, self.image_background_color)
+        draw = ImageDraw.ImageDraw(image)
+        for _ in range(width * height * self.image_noise_percent / 100):
+            draw.point((self.random.randint(0, width - 1), self.random.randint(0, height - 1)),
+                       tuple(self.random.randint(0, 255) for _ in range(3)))
+        return image
+
+    def create_image(self, code):
+        image = self.create_background()
         for i, c in enumerate(code):
             px = self.image_size[0] / 5 * i + self.image_offset * self.random.random() - self.image_offset / 2.0
             py = self.image_offset * self.random.random() - self.image_offset / 2.0
             pos = (int(px), int(py))
+            if self.use_atlas:
+                variants = self.char_atlas[c]
+                mask = variants[self.random.randint(0, len(variants) - 1)]
+                image.paste(self.char_color[c], pos, mask)
+                continue
             rotation = self.random.random() * self.image_rotation - self.image_rotation / 2.0
             scalar = self.image_scalar[0] + self.random.random() * (self.image_scalar[1] - self.image_scalar[0])
             resize = (int(self.char_image[c].size[0] * scalar), int(self.char_image[c].size[1] * scalar))
             cm = self.char_image[c].resize(resize, self.image_sample).rotate(rotation, self.image_sample, True)
             image.paste(cm, (pos[0], pos[1]), cm)
+        # gif is always palette mode
+        if self.image_palette or self.image_format == 'gif':
+            image = image.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=self.image_palette_colors)
         stream = StringIO()
-        image.save(stream, 'png')
-        return "data:image/png;base64," + stream.getvalue().encode("base64")
+        image.save(stream, self.image_format, optimize=True)
+        return stream.getvalue()
 
-    def new(self):
+    def render(self):
         code = self.create_code()
-        image = self.create_image(code)
+        return code, self.create_image(code)
+
+    def render_options(self):
+        """
+        constructor arguments a process pool worker needs to render alike
+        """
+        return dict(
+            image_format=self.image_format,
+            image_palette=self.image_palette,
+            use_atlas=self.use_atlas,
+            image_noise_percent=self.image_noise_percent)
+
+    def render_async(self):
+        """
+        render a (code, image) pair off the IOLoop
+        :return: concurrent.futures.Future
+        """
+        if self.use_process_pool:
+            return executors.get_process_pool().submit(_render_in_worker, self.render_options())
+        future = tornado.concurrent.Future()
+        future.set_result(self.render())
+        return future
+
+    def refill_pool(self):
+        """
+        start a background thread filling the pool up to pool_size
+        does nothing if a refill is already running
+        :return: True if a new refill thread is started
+        """
+        with self._pool_lock:
+            if self._pool_refilling or len(self.pool) >= self.pool_size:
+                return False
+            self._pool_refilling = True
+        thread = threading.Thread(target=self._refill_pool_worker, name='verification-pool-refill')
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _refill_pool_worker(self):
+        try:
+            while len(self.pool) < self.pool_size:
+                if self.use_process_pool:
+                    # spread one batch across the pool workers
+                    futures = [self.render_async() for _ in range(self.pool_size - len(self.pool))]
+                    for future in futures:
+                        self.pool.append(future.result())
+                else:
+                    self.pool.append(self.render())
+        finally:
+            with self._pool_lock:
+                self._pool_refilling = False
+
+    def pool_stats(self):
+        return dict(
+            size=len(self.pool),
+            capacity=self.pool_size,
+            hit=self.pool_hit,
+            miss=self.pool_miss)
+
+    def _pop_pool(self):
+        try:
+            item = self.pool.popleft()
+            self.pool_hit += 1
+        except IndexError:
+            item = None
+            if self.pool_size > 0:
+                self.pool_miss += 1
+        if len(self.pool) < self.pool_low_water or (self.pool_size > 0 and not self.pool):
+            self.refill_pool()
+        return item
+
+    def new(self):
+        item = self._pop_pool()
+        code, image = item if item is not None else self.render()
+        return self._add(code, image)
+
+    @tornado.gen.coroutine
+    def new_async(self):
+        """
+        coroutine version of new()
+        a pool miss is rendered in the process pool instead of on the IOLoop
+        """
+        item = self._pop_pool()
+        if item is None:
+            item = yield self.render_async()
+        code, image = item
+        verification_code = yield self._run_store(self._add, code, image)
+        raise tornado.gen.Return(verification_code)
+
+    def _run_store(self, function, *args):
+        """
+        call function in the database pool if the store blocks, e.g. on locks shared with other processes
+        :return: Future
+        """
+        if self.store.blocking:
+            return executors.get_database_pool().submit(function, *args)
+        future = tornado.concurrent.Future()
+        future.set_result(function(*args))
+        return future
+
+    def _add(self, code, image):
         vc = VerificationCode(code,
                               image,
+                              self.image_format,
                               self.available_count,
                               self.available_time,
                               self.case_sensitive,
                               self.code_alike)
-        self.container[vc.uuid] = vc
+        self.store.add(vc)
         return vc
 
+    def get(self, uuid):
+        verification_code = self.store.get(uuid)
+        if verification_code is None or not verification_code.is_time_available():
+            return None
+        return verification_code
+
+    def get_async(self, uuid):
+        """
+        get() off the IOLoop when the store blocks
+        :return: Future
+        """
+        return self._run_store(self.get, uuid)
+
     def check(self, uuid, code):
-        if len(self.container) > self.drop_size:
-            self.drop()
-        verification_code = self.container.get(uuid, None)
+        # count the attempt first, the store makes it atomic across processes
+        verification_code = self.store.incr(uuid)
         if verification_code is None:
             return False
-        if verification_code.check(code):
+        if verification_code.match(code):
             return True
         if not verification_code.is_available():
-            del self.container[verification_code.uuid]
+            self.store.remove(verification_code.uuid)
         return False
 
+    def check_async(self, uuid, code):
+        """
+        check() off the IOLoop when the store blocks
+        :return: Future
+        """
+        return self._run_store(self.check, uuid, code)
+
     def drop(self):
-        count = 0
-        for verification_code in self.container.values():
-            if not verification_code.is_available():
-                count += 1
-                del self.container[verification_code.uuid]
-        return count
+        return self.store.sweep()
+
+    def drop_async(self):
+        # errors are logged by the IOLoop
+        tornado.ioloop.IOLoop.current().add_future(self._run_store(self.drop), lambda future: future.result())
+
+    def start_sweeper(self, interval):
+        """
+        sweep expired codes every interval seconds on the current IOLoop
+        :param interval: seconds
+        :return: tornado.ioloop.PeriodicCallback
+        """
+        sweeper = tornado.ioloop.PeriodicCallback(self.drop_async, interval * 1000)
+        sweeper.start()
+        return sweeper
 
     @classmethod
     def instance(cls):
         if not hasattr(cls, '__instance__'):
-            cls.__instance__ = cls()
+            cls.__instance__ = cls(
+                pool_size=configs.verification_pool_size,
+                pool_low_water=configs.verification_pool_low_water,
+                use_process_pool=configs.verification_use_process_pool,
+                image_format=configs.verification_image_format,
+                image_palette=configs.verification_image_palette,
+                store=create_store(configs.verification_store),
+                use_atlas=configs.verification_use_atlas,
+                image_noise_percent=configs.verification_image_noise_percent)
         return cls.__instance__
 
 
+class VerificationStore(object):
+    """
+    VerificationStore
+    storage of the live verification codes
+    """
+    # calls may wait on other processes, Verification runs them in the database pool
+    blocking = False
+
+    def add(self, verification_code):
+        raise NotImplementedError()
+
+    def get(self, uuid):
+        """
+        :return: VerificationCode or None
+        """
+        raise NotImplementedError()
+
+    def incr(self, uuid):
+        """
+        count a check attempt of the code atomically
+        :return: VerificationCode with the increased count or None
+        """
+        raise NotImplementedError()
+
+    def remove(self, uuid):
+        raise NotImplementedError()
+
+    def sweep(self):
+        """
+        drop expired codes
+        :return: count of dropped codes
+        """
+        raise NotImplementedError()
+
+    def stats(self):
+        raise NotImplementedError()
+
+
+class VerificationContainer(VerificationStore):
+    """
+    in-memory VerificationStore, uuid -> VerificationCode
+    only visible to the current process
+
+    codes expire in creation order, so expired codes are always at the head
+    of expire_queue and sweep() costs O(1) amortized per code
+    once capacity is reached the least recently used code is evicted
+    """
+    def __init__(self, capacity):
+        VerificationStore.__init__(self)
+        self.capacity = capacity
+        # least recently used first
+        self.codes = collections.OrderedDict()
+        # (expire_timestamp, uuid) in creation order
+        self.expire_queue = collections.deque()
+        self.expired_count = 0
+        self.evicted_count = 0
+
+    def __len__(self):
+        return len(self.codes)
+
+    def add(self, verification_code):
+        self.sweep()
+        self.codes[verification_code.uuid] = verification_code
+        self.expire_queue.append(
+            (verification_code.begin_timestamp + verification_code.available_time, verification_code.uuid))
+        while len(self.codes) > self.capacity:
+            self.codes.popitem(last=False)
+            self.evicted_count += 1
+
+    def get(self, uuid):
+        verification_code = self.codes.pop(uuid, None)
+        if verification_code is not None:
+            # move to the most recently used end
+            self.codes[uuid] = verification_code
+        return verification_code
+
+    def incr(self, uuid):
+        verification_code = self.get(uuid)
+        if verification_code is not None:
+            verification_code.count += 1
+        return verification_code
+
+    def remove(self, uuid):
+        return self.codes.pop(uuid, None)
+
+    def sweep(self):
+        now = time.time()
+        count = 0
+        while self.expire_queue and self.expire_queue[0][0] < now:
+            _, uuid = self.expire_queue.popleft()
+            # the code may have been removed or evicted already
+            if self.codes.pop(uuid, None) is not None:
+                count += 1
+        self.expired_count += count
+        return count
+
+    def stats(self):
+        return dict(
+            live=len(self.codes),
+            capacity=self.capacity,
+            expired=self.expired_count,
+            evicted=self.evicted_count)
+
+
+class SQLiteVerificationStore(VerificationStore):
+    """
+    VerificationStore in a sqlite file
+    shared by every process on the host, so a code created by one worker
+    can be checked by another
+    """
+    blocking = True
+
+    def __init__(self, path, code_alike, busy_timeout=0.05):
+        """
+        :param busy_timeout: seconds to wait for a lock held by another process
+        """
+        VerificationStore.__init__(self)
+        self.path = path
+        self.code_alike = code_alike
+        self.busy_timeout = busy_timeout
+        # one connection per thread of the database pool
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        # sqlite connections must not be shared with forked children
+        local = self._local
+        if getattr(local, 'connection', None) is None or local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # codes live for a minute, a commit lost to a power failure costs a retry
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS t_verification_code ('
+                'uuid TEXT PRIMARY KEY, code TEXT, image_data BLOB, image_format TEXT, '
+                'count INTEGER, available_count INTEGER, available_time REAL, case_sensitive INTEGER, '
+                'begin_timestamp REAL, expire_timestamp REAL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS i_verification_code_expire '
+                'ON t_verification_code (expire_timestamp)')
+            local.connection = connection
+            local.pid = os.getpid()
+        return local.connection
+
+    def _load(self, row):
+        if row is None:
+            return None
+        uuid, code, image_data, image_format, count, available_count, available_time, case_sensitive, \
+            begin_timestamp = row
+        return VerificationCode(code, str(image_data), str(image_format),
+                                available_count, available_time, bool(case_sensitive), self.code_alike,
+                                uuid=str(uuid), begin_timestamp=begin_timestamp, count=count)
+
+    def _select(self, uuid):
+        return self._load(self.connection.execute(
+            'SELECT uuid, code, image_data, image_format, count, available_count, available_time, '
+            'case_sensitive, begin_timestamp FROM t_verification_code '
+            'WHERE uuid = ? AND expire_timestamp >= ?', (uuid, time.time())).fetchone())
+
+    def add(self, verification_code):
+        self.connection.execute(
+            'INSERT INTO t_verification_code VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (verification_code.uuid, verification_code.code,
+             sqlite3.Binary(verification_code.image_data), verification_code.image_format,
+             verification_code.count, verification_code.available_count, verification_code.available_time,
+             int(verification_code.case_sensitive), verification_code.begin_timestamp,
+             verification_code.begin_timestamp + verification_code.available_time))
+
+    def get(self, uuid):
+        return self._select(uuid)
+
+    def incr(self, uuid):
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'UPDATE t_verification_code SET count = count + 1 WHERE uuid = ?', (uuid,))
+            verification_code = self._select(uuid)
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return verification_code
+
+    def remove(self, uuid):
+        self.connection.execute('DELETE FROM t_verification_code WHERE uuid = ?', (uuid,))
+
+    def sweep(self):
+        return self.connection.execute(
+            'DELETE FROM t_verification_code WHERE expire_timestamp < ?', (time.time(),)).rowcount
+
+    def stats(self):
+        live, = self.connection.execute(
+            'SELECT COUNT(*) FROM t_verification_code WHERE expire_timestamp >= ?', (time.time(),)).fetchone()
+        return dict(live=live)
+
+
+def create_store(name):
+    """
+    create the VerificationStore named by config 'verification_store'
+    :param name: "memory" or "sqlite"
+    :return: VerificationStore
+    """
+    if name == 'memory':
+        return VerificationContainer(configs.verification_capacity)
+    elif name == 'sqlite':
+        from configs import ROOT_PATH
+        return SQLiteVerificationStore(
+            os.path.join(ROOT_PATH, configs.verification_store_path),
+            Verification.CODE_ALIKE,
+            configs.verification_store_busy_timeout_ms / 1000.0)
+    raise ValueError('ValueError: unknown verification store "%s"' % name)
+
+
 class VerificationCode(object):
-    def __init__(self, code, image, available_count, available_time, case_sensitive, code_alike):
+    def __init__(self, code, image_data, image_format, available_count, available_time, case_sensitive, code_alike,
+                 uuid=None, begin_timestamp=None, count=0):
         object.__init__(self)
-        self.uuid = hashlib.sha256("%s-%s" % (hex(id(self)), hex(int(time.time() * 1000)))).hexdigest()
-        self.begin_timestamp = time.time()
-        self.count = 0
+        if uuid is None:
+            uuid = hashlib.sha256("%s-%s-%s" % (
+                hex(id(self)), hex(int(time.time() * 1000)), os.urandom(16))).hexdigest()
+        self.uuid = uuid
+        self.begin_timestamp = begin_timestamp if begin_timestamp is not None else time.time()
+        self.count = count
         self.code = ''.join(code_alike.get(c, c) for c in code)
-        self.image = image
+        self.image_data = image_data
+        self.image_format = image_format
         self.available_count = available_count
         self.available_time = available_time
         self.case_sensitive = case_sensitive
         self.code_alike = code_alike
 
+    @property
+    def image(self):
+        """
+        url of the image, served by UI.Page.PageVerificationImage
+        """
+        return '/verification/%s.%s' % (self.uuid, self.image_format)
+
     def is_time_available(self):
         return (time.time() - self.begin_timestamp) <= self.available_time
 
@@ -138,8 +604,14 @@ class VerificationCode(object):
         return self.is_time_available() and self.is_count_available()
 
     def check(self, code):
-        code = ''.join(self.code_alike.get(c, c) for c in code)
         self.count += 1
+        return self.match(code)
+
+    def match(self, code):
+        """
+        check the code without counting an attempt
+        """
+        code = ''.join(self.code_alike.get(c, c) for c in code)
         if self.is_available():
             if self.case_sensitive:
                 if code == self.code:
@@ -152,10 +624,11 @@ class VerificationCode(object):
 
 def check(method):
     @functools.wraps(method)
+    @tornado.gen.coroutine
     def wrapper(self, *args, **kwargs):
         code = self.get_argument("ver_code")
         uuid = self.get_argument("ver_uuid")
-        success = Verification.instance().check(uuid, code)
+        success = yield Verification.instance().check_async(uuid, code)
         if not success:
             from UI.Page import NoticeAndRedirectInterruption
             raise NoticeAndRedirectInterruption(
@@ -164,5 +637,6 @@ def check(method):
                 redirect_to=None,
                 countdown=10, style='warning')
         else:
-            return method(self, *args, **kwargs)
+            result = yield method(self, *args, **kwargs)
+            raise tornado.gen.Return(result)
     return wrapper
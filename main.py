@@ -7,16 +7,126 @@ main.py
 
 __author__ = 'Rnd495'
 
+
+def check_configs():
+    """
+    configs several workers cannot run with
+    """
+    from core.configs import Configs
+    if Configs.instance().verification_store == 'memory':
+        raise ValueError('ValueError: verification_store "memory" keeps the verification codes of a worker '
+                         'to itself, set it to "sqlite" to run several workers')
+
+
+def serve(sockets, slot=0, heartbeat_fd=None, workers=1, epoch=None):
+    """
+    run the application on sockets until SIGTERM
+    :param sockets: listening sockets, bound by this process when options.reuse_port is set
+    :param heartbeat_fd: pipe to the supervisor, see core.supervisor.Heartbeat
+    :param workers: count of workers, they share the process pool sizes out
+    :param epoch: version epoch shared by the workers, see core.models.set_version_epoch
+    """
+    import os
+    import signal
+    import tornado.gen
+    import tornado.ioloop
+    import tornado.netutil
+    import tornado.httpserver
+    from tornado.options import options
+    from tornado.log import app_log
+    import core.models
+    from core import executors
+    from core.supervisor import Heartbeat, RequestCounter
+    from UI.Manager import create_app
+
+    # again in every worker, SIGHUP may have changed the config
+    check_configs()
+    executors.set_worker_count(workers)
+    if epoch is not None:
+        core.models.set_version_epoch(epoch)
+    app = create_app()
+    if sockets is None:
+        # pool processes holding a SO_REUSEPORT socket would be handed connections
+        executors.start_process_pools()
+        sockets = tornado.netutil.bind_sockets(options.port, options.ip, reuse_port=True)
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    io_loop = tornado.ioloop.IOLoop.current()
+
+    counter = RequestCounter(app)
+    if heartbeat_fd is not None:
+        Heartbeat(heartbeat_fd, slot, counter, options.heartbeat_interval).start()
+
+    @tornado.gen.coroutine
+    def shutdown():
+        # stop accepting, the other workers share or own the port meanwhile
+        server.stop()
+        deadline = io_loop.time() + options.shutdown_timeout
+        # close_all_connections drops requests in flight, wait for them first
+        while counter.inflight and io_loop.time() < deadline:
+            yield tornado.gen.sleep(0.05)
+        yield server.close_all_connections()
+        io_loop.stop()
+
+    def on_signal(signum, frame):
+        app_log.info("worker %d stopping, pid %d", slot, os.getpid())
+        io_loop.add_callback_from_signal(shutdown)
+    signal.signal(signal.SIGTERM, on_signal)
+
+    io_loop.start()
+    executors.shutdown(wait=True)
+
+
+def prepare():
+    """
+    runs once before the workers are forked, in a child process of the supervisor
+    """
+    from core.models_init import init
+    check_configs()
+    # before any worker may race on an empty database
+    init()
+
+
 if __name__ == '__main__':
+    import os
+    import sys
     import tornado.ioloop
+    import tornado.netutil
+    import tornado.process
     from tornado.options import options, define
-    from UI.Manager import create_app
 
     define("port", default=80, help="run on the given port", type=int)
     define("ip", default="0.0.0.0", help="binding on the given ip", type=str)
+    define("processes", default=1, help="worker processes, 0 means one per cpu", type=int)
+    define("reuse_port", default=False, help="every worker binds its own SO_REUSEPORT socket", type=bool)
+    define("heartbeat_interval", default=1, help="seconds between worker health reports", type=int)
+    define("heartbeat_timeout", default=10, help="seconds without health report before a worker is killed", type=int)
+    define("health_log_interval", default=60, help="seconds between worker health logs", type=int)
+    define("shutdown_timeout", default=10, help="seconds a stopping worker waits for requests in flight", type=int)
 
     tornado.options.parse_command_line()
-    app = create_app()
-    app.listen(options.port, options.ip)
-    print "starting service on %s:%s" % (options.ip, options.port)
-    tornado.ioloop.IOLoop.instance().start()
\ No newline at end of file
+    if options.processes == 1:
+        from UI.Manager import create_app
+        app = create_app()
+        app.listen(options.port, options.ip)
+        print "starting service on %s:%s" % (options.ip, options.port)
+        tornado.ioloop.IOLoop.instance().start()
+    else:
+        from core.supervisor import Supervisor, run_forked
+
+        # the supervisor never imports core or UI modules, every worker
+        # imports them anew, so SIGHUP reloads their code and the config
+        if run_forked(prepare) != 0:
+            sys.exit(1)
+        shared_sockets = None
+        if not options.reuse_port:
+            shared_sockets = tornado.netutil.bind_sockets(options.port, options.ip)
+
+        workers = options.processes or tornado.process.cpu_count()
+        supervisor = Supervisor(
+            lambda slot, heartbeat_fd: serve(shared_sockets, slot, heartbeat_fd, workers, supervisor.epoch),
+            workers,
+            heartbeat_timeout=options.heartbeat_timeout,
+            health_log_interval=options.health_log_interval)
+        print "starting %d workers on %s:%s, pid %d" % (supervisor.processes, options.ip, options.port, os.getpid())
+        supervisor.run()